@@ -1,13 +1,25 @@
+import argparse
+import asyncio
+import hashlib
+import io
 import json
 import logging
+import multiprocessing
 import os
 import queue
+import random
+import re
 import sqlite3
 import threading
+import time
 import tkinter as tk
 import uuid
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from tkinter import filedialog
 from tkinter import messagebox
 from tkinter import ttk
 from tkinter.font import Font
@@ -18,6 +30,9 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # 配置文件路径
 CONFIG_FILE = "config.json"
 
+# 本地数据库路径
+DB_PATH = "stock_data.db"
+
 # 默认公告内容
 DEFAULT_ANNOUNCEMENTS = [
     "系统公告：所有数据来源于公开市场信息，仅供参考，不构成投资建议。"
@@ -25,11 +40,264 @@ DEFAULT_ANNOUNCEMENTS = [
 
 DEFAULT_API_KEY = "sk-xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx"
 
+# 默认运行参数，可在config.json的settings中覆盖
+DEFAULT_SETTINGS = {
+    # 大笔买入入库方式：incremental 增量追加，full 每次删除后全量重写
+    "ingest_mode": "incremental",
+    # 实时行情补充方式：snapshot 全市场快照一次性关联，per_stock 逐只调用盘口接口
+    "enrich_mode": "snapshot",
+    # 抓取调度参数，键与FetchScheduler的构造参数一致，未配置的项使用默认值
+    "fetch_scheduler": {},
+    # 个股补充引擎：threads 线程池逐只调用akshare，asyncio 共享连接池的异步引擎
+    "enrich_engine": "threads",
+    # 异步引擎参数，键与AsyncEnrichmentEngine的构造参数一致
+    "async_engine": {},
+    # 界面点击刷新时是否自己采集；由ingest守护进程采集时设为false，界面只读取数据库
+    "ingest_in_gui": True,
+    # 交易时段内界面自动刷新的间隔（秒），0为关闭
+    "auto_refresh_seconds": 30,
+    # K线图绘制方式：embedded 在界面线程嵌入matplotlib画布（可缩放，实时更新只重绘数据图元），
+    # offscreen 在渲染进程池中离屏绘制，界面只显示绘制好的位图，多个窗口可并行绘制
+    "kline_render_mode": "embedded",
+    # offscreen模式的渲染进程数
+    "render_processes": 2,
+    # 同时打开的K线图窗口上限，超出时关闭最久未使用的窗口
+    "max_kline_windows": 6,
+    # 个股资金流当日数据的缓存有效期（秒），历史日期的数据永久缓存
+    "fund_flow_ttl_seconds": 120,
+    # 每次刷新后在后台预取资金流的股票数（按当前排序取前若干只），0为关闭
+    "fund_flow_prefetch": 30,
+    # 主表资金流排名列的数据有效期（秒），过期后下次刷新时整体重新获取
+    "fund_flow_rank_ttl_seconds": 30,
+}
+
+# 全市场快照字段到stock_real_data字段的映射
+SPOT_COLUMN_MAPPING = {
+    '最新价': '最新',
+    '涨跌幅': '涨幅',
+    '今开': '今开',
+    '最高': '最高',
+    '最低': '最低',
+    '换手率': '换手',
+    '量比': '量比',
+    '昨收': '昨收',
+    '总市值': '总市值',
+}
+
+# 界面从进度事件通道取事件的间隔（毫秒）
+PROGRESS_TICK_MS = 100
+# 筛选条件连续变化时的防抖间隔（毫秒）
+FILTER_DEBOUNCE_MS = 250
+# 主表格行高（像素）和可见行之外预先生成的行数
+TABLE_ROW_HEIGHT = 30
+TABLE_OVERSCAN = 5
+# K线图窗口实时更新时补拉新K线的间隔（毫秒）
+LIVE_CHART_POLL_MS = 10000
+# K线图周期（分钟）和日期范围（交易日数），都由本地1分钟K线得到
+KLINE_PERIODS = {'1分钟': 1, '5分钟': 5, '15分钟': 15, '30分钟': 30, '60分钟': 60}
+KLINE_RANGES = {'当日': 1, '近3日': 3, '近5日': 5}
+# 折线超过该点数时抽稀后再绘制
+KLINE_MAX_POINTS = 600
+# 一个交易日的1分钟K线根数
+SESSION_MINUTES = 240
+# 分时网格最多显示的股票数（按当前排序取前若干只）
+SPARKLINE_MAX_STOCKS = 100
+
+# 大笔买入事件的自然键，增量入库时据此去重
+BIG_BUY_NATURAL_KEY = ['时间', '代码', '成交量', '成交价']
+# 数据源会补发时间早于高水位的事件，增量入库时从高水位往前回看这么多秒比对
+INGEST_OVERLAP_SECONDS = 300
+
+# stock_changes表中除日期外的字段
+BIG_BUY_COLUMNS = ['时间', '代码', '名称', '板块', '成交量', '成交价', '占成交量比', '成交金额']
+# 明细索引中按数值数组保存的列，时间另存为当天的秒数
+BIG_BUY_INDEX_FIELDS = ['成交量', '成交价', '占成交量比', '成交金额']
+
+# stock_real_data表中除日期外的字段
+REAL_DATA_COLUMNS = ['代码', '名称', '交易所', '市场板块', '行业', '总市值', '最新', '涨幅', '最高', '最低', '涨停', '换手', '量比', '今开']
+
+# 统一的按日期分区的表结构
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS stock_changes (
+    日期 TEXT NOT NULL,
+    时间 TEXT NOT NULL,
+    代码 TEXT NOT NULL,
+    名称 TEXT,
+    板块 TEXT,
+    成交量 REAL,
+    成交价 REAL,
+    占成交量比 REAL,
+    成交金额 REAL
+);
+-- 自然键唯一索引，同时承担按(日期, 时间)的范围查询
+CREATE UNIQUE INDEX IF NOT EXISTS idx_stock_changes_date_time ON stock_changes (日期, 时间, 代码, 成交量, 成交价);
+CREATE INDEX IF NOT EXISTS idx_stock_changes_date_code ON stock_changes (日期, 代码);
+
+CREATE TABLE IF NOT EXISTS stock_real_data (
+    日期 TEXT NOT NULL,
+    代码 TEXT NOT NULL,
+    名称 TEXT,
+    交易所 TEXT,
+    市场板块 TEXT,
+    行业 TEXT,
+    总市值 INTEGER,
+    最新 REAL,
+    涨幅 REAL,
+    最高 REAL,
+    最低 REAL,
+    涨停 REAL,
+    换手 REAL,
+    量比 REAL,
+    今开 REAL,
+    PRIMARY KEY (日期, 代码)
+);
+
+-- 每只股票每天一行的大笔买入汇总，随事件入库增量维护，主界面只查询这张表
+CREATE TABLE IF NOT EXISTS stock_daily_summary (
+    日期 TEXT NOT NULL,
+    代码 TEXT NOT NULL,
+    名称 TEXT,
+    成交笔数 INTEGER NOT NULL,
+    成交金额合计 REAL NOT NULL,
+    最大成交金额 REAL NOT NULL,
+    首次时间 TEXT,
+    最后时间 TEXT,
+    时间金额明细 TEXT,
+    PRIMARY KEY (日期, 代码)
+);
+
+CREATE TABLE IF NOT EXISTS ingest_watermark (
+    日期 TEXT PRIMARY KEY,
+    high_water_mark TEXT,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS stock_reference (
+    代码 TEXT PRIMARY KEY,
+    行业 TEXT,
+    总股本 REAL,
+    流通股 REAL,
+    更新日期 TEXT
+);
+
+-- 1分钟K线本地缓存，按(代码, 日期, 复权方式)分段，minute_bar_sessions记录每段的最后时间和是否已收盘
+CREATE TABLE IF NOT EXISTS minute_bars (
+    代码 TEXT NOT NULL,
+    日期 TEXT NOT NULL,
+    复权 TEXT NOT NULL,
+    时间 TEXT NOT NULL,
+    开盘 REAL,
+    收盘 REAL,
+    最高 REAL,
+    最低 REAL,
+    成交量 REAL,
+    成交额 REAL,
+    均价 REAL,
+    PRIMARY KEY (代码, 日期, 复权, 时间)
+);
+
+CREATE TABLE IF NOT EXISTS minute_bar_sessions (
+    代码 TEXT NOT NULL,
+    日期 TEXT NOT NULL,
+    复权 TEXT NOT NULL,
+    最后时间 TEXT,
+    已收盘 INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (代码, 日期, 复权)
+);
+
+CREATE TABLE IF NOT EXISTS fund_flow (
+    代码 TEXT NOT NULL,
+    日期 TEXT NOT NULL,
+    收盘价 REAL,
+    涨跌幅 REAL,
+    "主力净流入-净额" REAL,
+    "主力净流入-净占比" REAL,
+    "超大单净流入-净额" REAL,
+    "超大单净流入-净占比" REAL,
+    "大单净流入-净额" REAL,
+    "大单净流入-净占比" REAL,
+    "中单净流入-净额" REAL,
+    "中单净流入-净占比" REAL,
+    "小单净流入-净额" REAL,
+    "小单净流入-净占比" REAL,
+    PRIMARY KEY (代码, 日期)
+);
+
+CREATE TABLE IF NOT EXISTS fund_flow_fetches (
+    代码 TEXT PRIMARY KEY,
+    更新时间 TEXT NOT NULL
+);
+
+-- 大笔买入明细索引：每只股票每天一行，事件按时间排序、转成数值数组后打包
+CREATE TABLE IF NOT EXISTS big_buy_index (
+    日期 TEXT NOT NULL,
+    代码 TEXT NOT NULL,
+    名称 TEXT,
+    板块 TEXT,
+    笔数 INTEGER NOT NULL,
+    数据 BLOB NOT NULL,
+    PRIMARY KEY (日期, 代码)
+);
+"""
+
+SQLITE_PRAGMAS = [
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-32000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+]
+
+# 写入语句保持固定文本，长连接上由sqlite3的语句缓存复用编译好的语句
+STATEMENT_CACHE_SIZE = 256
+INSERT_BIG_BUY_SQL = f"INSERT OR IGNORE INTO stock_changes (日期, {', '.join(BIG_BUY_COLUMNS)}) VALUES (?{', ?' * len(BIG_BUY_COLUMNS)})"
+INSERT_REAL_DATA_SQL = f"INSERT OR REPLACE INTO stock_real_data (日期, {', '.join(REAL_DATA_COLUMNS)}) VALUES (?{', ?' * len(REAL_DATA_COLUMNS)})"
+# 把rowid大于给定值的当日事件按股票汇总，累加到stock_daily_summary；rowid取0时即为重建当日汇总
+UPSERT_DAILY_SUMMARY_SQL = """
+INSERT INTO stock_daily_summary (日期, 代码, 名称, 成交笔数, 成交金额合计, 最大成交金额, 首次时间, 最后时间, 时间金额明细)
+SELECT 日期, 代码, MAX(名称), COUNT(1), TOTAL(成交金额), MAX(IFNULL(成交金额, 0)), MIN(时间), MAX(时间),
+       GROUP_CONCAT(CAST(成交金额 / 10000 AS INTEGER) || '万(' || 时间 || ')', '|')
+FROM stock_changes
+WHERE 日期 = ? AND rowid > ?
+GROUP BY 日期, 代码
+ON CONFLICT (日期, 代码) DO UPDATE SET
+    名称 = excluded.名称,
+    成交笔数 = 成交笔数 + excluded.成交笔数,
+    成交金额合计 = 成交金额合计 + excluded.成交金额合计,
+    最大成交金额 = MAX(最大成交金额, excluded.最大成交金额),
+    首次时间 = MIN(首次时间, excluded.首次时间),
+    最后时间 = MAX(最后时间, excluded.最后时间),
+    时间金额明细 = COALESCE(时间金额明细 || '|' || excluded.时间金额明细, 时间金额明细, excluded.时间金额明细)
+"""
+MINUTE_BAR_COLUMNS = ['时间', '开盘', '收盘', '最高', '最低', '成交量', '成交额', '均价']
+INSERT_MINUTE_BAR_SQL = f"INSERT OR REPLACE INTO minute_bars (代码, 日期, 复权, {', '.join(MINUTE_BAR_COLUMNS)}) VALUES (?, ?, ?{', ?' * len(MINUTE_BAR_COLUMNS)})"
+# 个股资金流字段，与ak.stock_individual_fund_flow一致；列名含“-”，SQL中加引号
+FUND_FLOW_COLUMNS = [
+    '日期', '收盘价', '涨跌幅',
+    '主力净流入-净额', '主力净流入-净占比', '超大单净流入-净额', '超大单净流入-净占比',
+    '大单净流入-净额', '大单净流入-净占比', '中单净流入-净额', '中单净流入-净占比',
+    '小单净流入-净额', '小单净流入-净占比',
+]
+FUND_FLOW_SELECT = ', '.join(f'"{column}"' for column in FUND_FLOW_COLUMNS)
+INSERT_FUND_FLOW_SQL = f"INSERT OR REPLACE INTO fund_flow (代码, {FUND_FLOW_SELECT}) VALUES (?{', ?' * len(FUND_FLOW_COLUMNS)})"
+# 主表可选的资金流排名列：列名 → (ak.stock_individual_fund_flow_rank的indicator, 源字段)，单位万元
+FUND_FLOW_RANK_COLUMNS = {
+    '今日主力净流入': ('今日', '今日主力净流入-净额'),
+    '近3日主力净流入': ('3日', '3日主力净流入-净额'),
+    '近5日主力净流入': ('5日', '5日主力净流入-净额'),
+}
+# 主界面中按数值筛选和排序的列，空表或整列NULL时也按数值处理
+SCREENING_NUMERIC_COLUMNS = ['总市值', '总成交金额', '涨幅', '总成笔数', '换手', '量比']
+UPSERT_REFERENCE_SQL = "INSERT OR REPLACE INTO stock_reference (代码, 行业, 总股本, 流通股, 更新日期) VALUES (?, ?, ?, ?, ?)"
+
+# 已建表的数据库，每个进程只执行一次建表语句
+_initialized_databases = set()
+_database_init_lock = threading.Lock()
+
 # 全局变量，延迟初始化
 ak = None
 matplotlib = None
-plt = None
-mpf = None
+np = None
 pd = None
 FigureCanvasTkAgg = None
 NavigationToolbar2Tk = None
@@ -48,22 +316,20 @@ def ensure_config_file():
 
 def lazy_import_heavy_modules():
     """延迟导入重型模块"""
-    global ak, matplotlib, plt, mpf, pd, FigureCanvasTkAgg, NavigationToolbar2Tk
+    global ak, matplotlib, np, pd, FigureCanvasTkAgg, NavigationToolbar2Tk
 
     if ak is None:
         logging.info("正在导入数据处理模块...")
         try:
             import akshare as ak_module
             import matplotlib as matplotlib_module
-            import matplotlib.pyplot as plt_module
-            import mplfinance as mpf_module
+            import numpy as np_module
             import pandas as pd_module
             from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg as FigureCanvas, NavigationToolbar2Tk as NavToolbar
 
             ak = ak_module
             matplotlib = matplotlib_module
-            plt = plt_module
-            mpf = mpf_module
+            np = np_module
             pd = pd_module
             FigureCanvasTkAgg = FigureCanvas
             NavigationToolbar2Tk = NavToolbar
@@ -106,13 +372,43 @@ def load_api_key():
         return DEFAULT_API_KEY
 
 
-# Function to save results to Excel
-def save_to_excel(results: list, filename: str = "stock_data.xlsx"):
-    if pd is None:
-        lazy_import_heavy_modules()
-    df = pd.DataFrame(results)
-    df.to_excel(filename, index=False, engine='openpyxl')
-    print(f"Data saved to {filename}")
+# 加载运行参数
+def load_settings():
+    settings = dict(DEFAULT_SETTINGS)
+    try:
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+            settings.update(config.get("settings", {}))
+    except Exception as e:
+        logging.error(f"读取运行参数失败: {e}")
+    return settings
+
+
+# 导出当前视图数据，格式由文件扩展名决定
+def export_data(df, filename):
+    """按扩展名导出：.xlsx用openpyxl只写模式逐行写入，.csv和.parquet由pandas写出"""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.csv':
+        df.to_csv(filename, index=False, encoding='utf-8-sig')
+    elif extension == '.parquet':
+        df.to_parquet(filename, index=False)
+    elif extension == '.xlsx':
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(list(df.columns))
+        for row in sql_rows(df, list(df.columns)):
+            sheet.append(row)
+        workbook.save(filename)
+    else:
+        raise ValueError(f"不支持的导出格式: {extension}")
+
+
+def content_hash(df):
+    """DataFrame内容（列名和全部值）的摘要，用于判断导出内容是否变化"""
+    digest = hashlib.sha1("|".join(map(str, df.columns)).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
 
 
 def get_stock_info(stock_code):
@@ -149,26 +445,1968 @@ def get_stock_info(stock_code):
         return ('unknown', '其他板块')
 
 
+def get_trading_date(now=None):
+    """获取当前对应的交易日：早于9:30取前一天，周末回退到周五"""
+    now = now or datetime.now()
+    market_open_time = datetime.strptime("09:30", "%H:%M").time()
+
+    # 如果当前时间早于9:30，使用前一天的日期
+    if now.time() < market_open_time:
+        target_date = now - timedelta(days=1)
+    else:
+        target_date = now
+
+    # 进一步处理周末情况
+    while target_date.weekday() > 4:  # 0-6代表周一到周日
+        target_date = target_date - timedelta(days=1)
+
+    return target_date
+
+
+def open_database(db_path=DB_PATH, read_only=False, **connect_kwargs):
+    """打开数据库连接：WAL模式和调优参数，首次打开时建表；read_only时打开只读连接，不建表"""
+    if read_only:
+        conn = sqlite3.connect(f"{Path(db_path).absolute().as_uri()}?mode=ro", uri=True, **connect_kwargs)
+    else:
+        conn = sqlite3.connect(db_path, **connect_kwargs)
+        conn.execute("PRAGMA journal_mode=WAL")
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    if not read_only:
+        with _database_init_lock:
+            if db_path not in _initialized_databases:
+                conn.executescript(SCHEMA_SQL)
+                _initialized_databases.add(db_path)
+    return conn
+
+
+def sql_rows(df, columns):
+    """DataFrame转为可直接绑定的参数行，缺失值转为None"""
+    values = df[columns].astype(object)
+    return list(values.where(values.notna(), None).itertuples(index=False, name=None))
+
+
+def migrate_legacy_tables(conn, drop_legacy=False):
+    """把旧版按天分表的stock_changes_YYYYMMDD/stock_real_data_YYYYMMDD导入统一表，可重复执行"""
+    legacy_tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+    migrated = 0
+    for table_name in legacy_tables:
+        match = re.fullmatch(r'(stock_changes|stock_real_data)_(\d{8})', table_name)
+        if not match:
+            continue
+        target, date = match.groups()
+        legacy_columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+        columns = [col for col in (BIG_BUY_COLUMNS if target == 'stock_changes' else REAL_DATA_COLUMNS) if col in legacy_columns]
+        column_list = ", ".join(columns)
+        verb = "INSERT OR IGNORE" if target == 'stock_changes' else "INSERT OR REPLACE"
+        cursor = conn.execute(f"{verb} INTO {target} (日期, {column_list}) SELECT ?, {column_list} FROM {table_name}", (date,))
+        logging.info(f"已导入 {table_name} -> {target}: {cursor.rowcount} 条记录")
+        if drop_legacy:
+            conn.execute(f"DROP TABLE {table_name}")
+        migrated += 1
+    if drop_legacy:
+        conn.execute("DROP TABLE IF EXISTS ingest_state")
+    # 补建缺少汇总的日期（旧表导入的数据和汇总表出现之前入库的数据）
+    missing_dates = [row[0] for row in conn.execute(
+        "SELECT DISTINCT 日期 FROM stock_changes WHERE 日期 NOT IN (SELECT DISTINCT 日期 FROM stock_daily_summary)")]
+    for date in missing_dates:
+        rebuild_daily_summary(conn, date)
+    logging.info(f"已重建 {len(missing_dates)} 个交易日的汇总数据")
+    # 补建缺少明细索引的日期
+    unindexed_dates = [row[0] for row in conn.execute(
+        "SELECT DISTINCT 日期 FROM stock_changes WHERE 日期 NOT IN (SELECT DISTINCT 日期 FROM big_buy_index)")]
+    for date in unindexed_dates:
+        update_big_buy_index(conn, date)
+    logging.info(f"已重建 {len(unindexed_dates)} 个交易日的大笔买入明细索引")
+    conn.commit()
+    return migrated
+
+
+def rebuild_daily_summary(conn, current_date):
+    """按stock_changes重建某一天的汇总"""
+    conn.execute("DELETE FROM stock_daily_summary WHERE 日期 = ?", (current_date,))
+    conn.execute(UPSERT_DAILY_SUMMARY_SQL, (current_date, 0))
+
+
+def big_buy_event_keys(df):
+    """按自然键(时间, 代码, 成交量, 成交价)生成事件键，用于去重"""
+    times = pd.to_datetime(df['时间']).dt.strftime('%Y-%m-%d %H:%M:%S')
+    volumes = pd.to_numeric(df['成交量'], errors='coerce').astype(float).round(0).astype(str)
+    prices = pd.to_numeric(df['成交价'], errors='coerce').astype(float).round(3).astype(str)
+    return times + '|' + df['代码'].astype(str) + '|' + volumes + '|' + prices
+
+
+def insert_big_buy_events(conn, current_date, events_df):
+    """插入大笔买入事件，实际插入的记录（按rowid识别）同时累加到当日汇总"""
+    rows = events_df[BIG_BUY_COLUMNS].copy()
+    rows['时间'] = rows['时间'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    last_rowid = conn.execute("SELECT IFNULL(MAX(rowid), 0) FROM stock_changes").fetchone()[0]
+    conn.executemany(INSERT_BIG_BUY_SQL, [(current_date,) + row for row in sql_rows(rows, BIG_BUY_COLUMNS)])
+    conn.execute(UPSERT_DAILY_SUMMARY_SQL, (current_date, last_rowid))
+    update_big_buy_index(conn, current_date, set(events_df['代码']))
+
+
+def pack_big_buy_events(frame):
+    """把按(代码, 时间)排好序的大笔买入事件按股票分组，返回[(代码, 名称, 板块, 笔数, 打包数据)]
+
+    时间转成当天的秒数，数值列转成float数组，用np.savez打包，明细窗口读取时不再解析字符串。
+    """
+    if frame.empty:
+        return []
+    times = pd.to_datetime(frame['时间'])
+    seconds = (times.dt.hour * 3600 + times.dt.minute * 60 + times.dt.second).to_numpy(dtype=np.int32)
+    values = {col: pd.to_numeric(frame[col], errors='coerce').to_numpy(dtype=float) for col in BIG_BUY_INDEX_FIELDS}
+    codes = frame['代码'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], len(codes)]
+    entries = []
+    for start, end in zip(starts, ends):
+        buffer = io.BytesIO()
+        np.savez(buffer, 秒=seconds[start:end], **{col: array[start:end] for col, array in values.items()})
+        entries.append((codes[start], frame['名称'].iat[start], frame['板块'].iat[start], int(end - start), buffer.getvalue()))
+    return entries
+
+
+def unpack_big_buy_events(data):
+    """解包pack_big_buy_events生成的数据，返回{字段: 数组}"""
+    with np.load(io.BytesIO(data)) as archive:
+        return {name: archive[name] for name in archive.files}
+
+
+def update_big_buy_index(conn, current_date, codes=None):
+    """按stock_changes重建某一天的大笔买入明细索引，codes给定时只重建这些股票；不提交事务"""
+    sql = f"SELECT {', '.join(BIG_BUY_COLUMNS)} FROM stock_changes WHERE 日期 = ?"
+    if codes is None:
+        conn.execute("DELETE FROM big_buy_index WHERE 日期 = ?", (current_date,))
+        frames = [pd.read_sql_query(sql + " ORDER BY 代码, 时间", conn, params=(current_date,))]
+    else:
+        # 分批查询，避免超出SQLite的参数个数上限
+        codes = sorted(codes)
+        frames = [pd.read_sql_query(sql + f" AND 代码 IN ({', '.join('?' * len(chunk))}) ORDER BY 代码, 时间",
+                                    conn, params=(current_date, *chunk))
+                  for chunk in (codes[i:i + 500] for i in range(0, len(codes), 500))]
+    conn.executemany(
+        "INSERT OR REPLACE INTO big_buy_index (日期, 代码, 名称, 板块, 笔数, 数据) VALUES (?, ?, ?, ?, ?, ?)",
+        [(current_date,) + entry for frame in frames for entry in pack_big_buy_events(frame)]
+    )
+
+
+def ingest_big_buy_events(conn, events_df, current_date, mode="incremental"):
+    """大笔买入事件入库，返回(新增记录数, 有新事件的股票代码集合)
+
+    incremental模式按日记录高水位时间，只和高水位往前INGEST_OVERLAP_SECONDS秒之后的已有记录按自然键比对，
+    追加新事件，重复的由唯一索引拒绝；full模式保持原有行为，删除当天数据后全量重写。
+    两种模式都推进高水位。不提交事务，由调用方（写线程）统一提交。
+    """
+    events_df = events_df.drop_duplicates(subset=BIG_BUY_NATURAL_KEY)
+    time_text = events_df['时间'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    row = conn.execute("SELECT high_water_mark FROM ingest_watermark WHERE 日期 = ?", (current_date,)).fetchone()
+    high_water_mark = row[0] if row else None
+
+    if mode != "incremental":
+        conn.execute("DELETE FROM stock_changes WHERE 日期 = ?", (current_date,))
+        conn.execute("DELETE FROM stock_daily_summary WHERE 日期 = ?", (current_date,))
+        conn.execute("DELETE FROM big_buy_index WHERE 日期 = ?", (current_date,))
+        new_rows = events_df
+        # 当天数据已整体重写，高水位以本次数据为准
+        high_water_mark = None
+    else:
+        # 没有高水位记录（刚迁移过来的数据）时与当天全部记录比对；
+        # 数据源补发的事件时间可能早于高水位，因此往前回看一段时间
+        floor = ''
+        if high_water_mark:
+            floor = (datetime.strptime(high_water_mark, '%Y-%m-%d %H:%M:%S')
+                     - timedelta(seconds=INGEST_OVERLAP_SECONDS)).strftime('%Y-%m-%d %H:%M:%S')
+        candidates = events_df[time_text >= floor]
+        existing_df = pd.read_sql_query(
+            "SELECT 时间, 代码, 成交量, 成交价 FROM stock_changes WHERE 日期 = ? AND 时间 >= ?",
+            conn, params=(current_date, floor)
+        )
+        new_rows = candidates[~big_buy_event_keys(candidates).isin(set(big_buy_event_keys(existing_df)))]
+
+    if not new_rows.empty:
+        insert_big_buy_events(conn, current_date, new_rows)
+    # 本次拉取的事件此时都已在库中，高水位推进到其中最晚的时间
+    if not events_df.empty:
+        high_water_mark = max(high_water_mark or '', time_text.max())
+
+    conn.execute(
+        "INSERT OR REPLACE INTO ingest_watermark (日期, high_water_mark, updated_at) VALUES (?, ?, ?)",
+        (current_date, high_water_mark, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    )
+    return len(new_rows), set(new_rows['代码'])
+
+
+def write_real_data(conn, current_date, real_data_list, incremental):
+    """写入stock_real_data表，增量模式下只替换本轮补充过的股票，否则先清空当天数据；不提交事务"""
+    stock_real_data_df = pd.DataFrame(real_data_list, columns=REAL_DATA_COLUMNS)
+    if not incremental:
+        conn.execute("DELETE FROM stock_real_data WHERE 日期 = ?", (current_date,))
+    conn.executemany(INSERT_REAL_DATA_SQL, [(current_date,) + row for row in sql_rows(stock_real_data_df, REAL_DATA_COLUMNS)])
+
+
+def fetch_spot_snapshot():
+    """获取全市场实时行情快照，按代码索引"""
+    spot_df = ak.stock_zh_a_spot_em()
+    snapshot = spot_df[['代码', '名称'] + list(SPOT_COLUMN_MAPPING)].rename(columns=SPOT_COLUMN_MAPPING)
+    for col in SPOT_COLUMN_MAPPING.values():
+        snapshot[col] = pd.to_numeric(snapshot[col], errors='coerce')
+    return snapshot.drop_duplicates(subset=['代码']).set_index('代码')
+
+
+def build_spot_quotes(stock_info, snapshot):
+    """将快照与待处理股票一次性关联，返回{代码: 行情字段}，快照中缺失的代码不在结果中"""
+    quotes = snapshot.loc[snapshot.index.intersection(stock_info['代码'])].copy()
+    if quotes.empty:
+        return {}
+
+    # 快照不含涨停价，按板块涨跌幅限制由昨收推算（ST 5%，创业板/科创板 20%，北交所 30%，其余 10%）
+    boards = pd.Series([get_stock_info(code) for code in quotes.index], index=quotes.index)
+    limit_ratio = pd.Series(0.10, index=quotes.index)
+    limit_ratio[boards.map(lambda info: info[1] in ('创业板', '科创板'))] = 0.20
+    limit_ratio[boards.map(lambda info: info[0] == 'bj')] = 0.30
+    limit_ratio[quotes['名称'].astype(str).str.contains('ST')] = 0.05
+    quotes['涨停'] = (quotes['昨收'] * (1 + limit_ratio) * 100 + 0.5) // 1 / 100
+    quotes['总市值'] = quotes['总市值'] // 100000000
+
+    quotes = quotes.drop(columns=['名称', '昨收']).astype(object)
+    return quotes.where(quotes.notna(), None).to_dict('index')
+
+
+def build_real_data_record(stock_code, stock_name, reference, quote):
+    """由基础资料和行情组装stock_real_data的一行，总市值由总股本×最新价推算（亿元）"""
+    if reference['总股本'] is not None and quote['最新'] is not None:
+        market_cap = int(reference['总股本'] * quote['最新'] / 100000000)
+    else:
+        market_cap = quote.get('总市值')
+    exchange, market = get_stock_info(stock_code)
+    return {
+        '代码': stock_code,
+        '名称': stock_name,
+        '交易所': exchange,
+        '市场板块': market,
+        '行业': reference['行业'],
+        '总市值': int(market_cap) if market_cap is not None else None,
+        '最新': quote['最新'],
+        '涨幅': quote['涨幅'],
+        '最高': quote['最高'],
+        '最低': quote['最低'],
+        '涨停': quote['涨停'],
+        '换手': quote['换手'],
+        '量比': quote['量比'],
+        '今开': quote['今开']
+    }
+
+
+class CircuitOpenError(Exception):
+    """接口已熔断，请求未发出"""
+
+
+def is_transient_error(error):
+    """判断是否为可重试的瞬时错误（网络、超时、限流等）"""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    module = type(error).__module__ or ''
+    if module.startswith(('requests', 'urllib3', 'httpx', 'http.client')):
+        return True
+    message = str(error)
+    return any(keyword in message for keyword in ('timed out', 'Timeout', 'Connection', '429', '502', '503', '504'))
+
+
+class TokenBucket:
+    """令牌桶限流：rate为每秒补充的令牌数，capacity为允许的突发量"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """阻塞直到取得一个令牌"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class CircuitBreaker:
+    """熔断器：连续瞬时错误达到阈值后打开，冷却时间过后放行一次试探请求"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'open':
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                # 冷却结束，只放行一个试探请求
+                self.state = 'half_open'
+                return True
+            return self.state == 'closed'
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.state = 'closed'
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    logging.warning(f"接口连续失败 {self.failures} 次，熔断 {self.reset_timeout} 秒")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+class AimdController:
+    """AIMD并发控制：每个统计窗口内错误率和平均延迟达标则并发+1，否则减半"""
+
+    def __init__(self, initial, minimum, maximum, target_latency, error_threshold, window=20):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.error_threshold = error_threshold
+        self.window = window
+        self.active = 0
+        self.samples = []
+        self.increases = 0
+        self.decreases = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def record(self, latency, failed):
+        """记录一次请求的延迟和结果，窗口满时调整并发上限"""
+        with self.condition:
+            self.samples.append((latency, failed))
+            if len(self.samples) < self.window:
+                return
+            avg_latency = sum(sample[0] for sample in self.samples) / len(self.samples)
+            error_rate = sum(1 for sample in self.samples if sample[1]) / len(self.samples)
+            self.samples = []
+            if error_rate > self.error_threshold or avg_latency > self.target_latency:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.decreases += 1
+            else:
+                self.limit = min(self.maximum, self.limit + 1)
+                self.increases += 1
+            self.condition.notify_all()
+
+
+class FetchScheduler:
+    """数据抓取调度器：AIMD自适应并发、分接口令牌桶限流、抖动退避重试和熔断"""
+
+    def __init__(self, initial_concurrency=8, min_concurrency=2, max_concurrency=32,
+                 target_latency=2.0, error_threshold=0.1, requests_per_second=10,
+                 endpoint_rates=None, max_retries=3, backoff_base=0.5, backoff_max=8.0,
+                 breaker_failures=5, breaker_reset=30):
+        self.concurrency = AimdController(initial_concurrency, min_concurrency, max_concurrency,
+                                          target_latency, error_threshold)
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.endpoint_rates = endpoint_rates or {}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def _endpoint(self, name):
+        with self.lock:
+            if name not in self.endpoints:
+                rate = self.endpoint_rates.get(name, self.requests_per_second)
+                self.endpoints[name] = {
+                    'bucket': TokenBucket(rate, max(1, rate)),
+                    'breaker': CircuitBreaker(self.breaker_failures, self.breaker_reset),
+                    'stats': {'calls': 0, 'successes': 0, 'failures': 0, 'retries': 0, 'rejected': 0, 'total_latency': 0.0},
+                }
+            return self.endpoints[name]
+
+    def _count(self, endpoint, key, value=1):
+        with self.lock:
+            endpoint['stats'][key] += value
+
+    @contextmanager
+    def slot(self):
+        """占用一个并发名额，包住一只股票的完整处理过程"""
+        self.concurrency.acquire()
+        try:
+            yield
+        finally:
+            self.concurrency.release()
+
+    def call(self, endpoint_name, func, *args, **kwargs):
+        """经限流、熔断和重试调用接口，瞬时错误按指数退避加随机抖动重试"""
+        endpoint = self._endpoint(endpoint_name)
+        for attempt in range(self.max_retries + 1):
+            if not endpoint['breaker'].allow():
+                self._count(endpoint, 'rejected')
+                raise CircuitOpenError(f"接口 {endpoint_name} 已熔断")
+            endpoint['bucket'].acquire()
+            self._count(endpoint, 'calls')
+            start = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                latency = time.monotonic() - start
+                transient = is_transient_error(e)
+                self.concurrency.record(latency, transient)
+                self._count(endpoint, 'failures')
+                if not transient:
+                    # 接口有响应，只是该股票的数据有问题，不计入熔断
+                    endpoint['breaker'].record_success()
+                    raise
+                endpoint['breaker'].record_failure()
+                if attempt >= self.max_retries:
+                    raise
+                self._count(endpoint, 'retries')
+                time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+                continue
+            latency = time.monotonic() - start
+            self.concurrency.record(latency, False)
+            endpoint['breaker'].record_success()
+            self._count(endpoint, 'successes')
+            self._count(endpoint, 'total_latency', latency)
+            return result
+
+    def get_stats(self):
+        """返回调度统计，用于调参"""
+        with self.lock:
+            endpoints = {}
+            for name, endpoint in self.endpoints.items():
+                stats = dict(endpoint['stats'])
+                stats['avg_latency'] = stats.pop('total_latency') / stats['successes'] if stats['successes'] else 0.0
+                stats['breaker'] = endpoint['breaker'].state
+                endpoints[name] = stats
+        return {
+            'concurrency_limit': self.concurrency.limit,
+            'active': self.concurrency.active,
+            'increases': self.concurrency.increases,
+            'decreases': self.concurrency.decreases,
+            'endpoints': endpoints,
+        }
+
+    def format_stats(self):
+        stats = self.get_stats()
+        parts = [f"并发上限 {stats['concurrency_limit']}（+{stats['increases']}/-{stats['decreases']}）"]
+        for name, endpoint in stats['endpoints'].items():
+            parts.append(f"{name}: 成功 {endpoint['successes']}/{endpoint['calls']}，重试 {endpoint['retries']}，"
+                         f"熔断拒绝 {endpoint['rejected']}，平均延迟 {endpoint['avg_latency']:.2f}s，熔断器 {endpoint['breaker']}")
+        return "；".join(parts)
+
+
+class StockDatabase:
+    """数据库服务：单一写线程按批提交事务，界面查询使用只读连接池
+
+    写入以函数的形式排队交给写线程，队列中积压的写入合并为一个事务，各自在保存点中执行，失败只回滚自身。
+    WAL模式下只读连接不会被写事务阻塞，刷新数据时详情窗口的查询照常进行。
+    """
+
+    def __init__(self, db_path=DB_PATH, read_pool_size=4, max_batch=64):
+        self.db_path = db_path
+        self.read_pool_size = read_pool_size
+        self.max_batch = max_batch
+        # 写连接在当前线程打开并建表，之后的只读连接打开时表结构已存在；事务由写线程显式控制
+        self.write_conn = open_database(db_path, check_same_thread=False, isolation_level=None,
+                                        cached_statements=STATEMENT_CACHE_SIZE)
+        self.write_queue = queue.Queue()
+        self.read_pool = queue.Queue()
+        self.read_conns = []
+        self.read_lock = threading.Lock()
+        self.writer = threading.Thread(target=self._writer_loop, name="DBWriter", daemon=True)
+        self.writer.start()
+
+    def submit(self, func, *args):
+        """提交写入，func(conn, *args)在写线程中执行，返回Future，事务提交后才有结果"""
+        future = Future()
+        self.write_queue.put((func, args, future))
+        return future
+
+    def write(self, func, *args):
+        """提交写入并等待事务提交，返回func的返回值"""
+        return self.submit(func, *args).result()
+
+    def _writer_loop(self):
+        stopping = False
+        while not stopping:
+            job = self.write_queue.get()
+            if job is None:
+                return
+            batch = [job]
+            # 合并已在队列中等待的写入
+            while len(batch) < self.max_batch:
+                try:
+                    job = self.write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        """在一个事务中执行一批写入，提交后再通知各自的Future"""
+        conn = self.write_conn
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for func, args, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT write_job")
+                try:
+                    outcomes.append((future, func(conn, *args), None))
+                except Exception as e:
+                    logging.error(f"数据库写入失败: {e}")
+                    conn.execute("ROLLBACK TO write_job")
+                    outcomes.append((future, None, e))
+                conn.execute("RELEASE write_job")
+            conn.execute("COMMIT")
+        except Exception as e:
+            logging.error(f"数据库事务提交失败: {e}")
+            try:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            except Exception as rollback_error:
+                logging.error(f"数据库事务回滚失败: {rollback_error}")
+            # 事务整体失败时，批内所有未取消的任务都以该异常结束，包括还没轮到执行的，否则write会一直等待
+            outcomes = [(future, None, e) for _, _, future in batch if not future.cancelled()]
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    @contextmanager
+    def reader(self):
+        """借用一个只读连接，用完归还；连接按需创建，最多read_pool_size个"""
+        try:
+            conn = self.read_pool.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self.read_lock:
+                if len(self.read_conns) < self.read_pool_size:
+                    conn = open_database(self.db_path, read_only=True, check_same_thread=False,
+                                         cached_statements=STATEMENT_CACHE_SIZE)
+                    self.read_conns.append(conn)
+            if conn is None:
+                conn = self.read_pool.get()
+        try:
+            yield conn
+        finally:
+            self.read_pool.put(conn)
+
+    def query(self, sql, params=()):
+        """只读查询，返回全部行"""
+        with self.reader() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def query_frame(self, sql, params=()):
+        """只读查询，返回DataFrame"""
+        with self.reader() as conn:
+            return pd.read_sql_query(sql, conn, params=params)
+
+    def close(self):
+        """等待已排队的写入提交后关闭全部连接"""
+        self.write_queue.put(None)
+        self.writer.join()
+        self.write_conn.close()
+        with self.read_lock:
+            for conn in self.read_conns:
+                conn.close()
+            self.read_conns.clear()
+
+
+class StockReferenceCache:
+    """股票基础资料缓存（行业、总股本、流通股），持久化在stock_reference表中，每个交易日最多刷新一次"""
+
+    def __init__(self, database, scheduler=None):
+        self.database = database
+        self.scheduler = scheduler
+        self.records = {}
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    def _ensure_loaded(self):
+        """首次使用时把已有记录读入内存"""
+        with self.lock:
+            if self.loaded:
+                return
+            for code, industry, total_shares, float_shares, updated in self.database.query(
+                    "SELECT 代码, 行业, 总股本, 流通股, 更新日期 FROM stock_reference"):
+                self.records[code] = {'行业': industry, '总股本': total_shares, '流通股': float_shares, '更新日期': updated}
+            self.loaded = True
+
+    def _is_fresh(self, record):
+        return record is not None and record['更新日期'] >= get_trading_date().strftime('%Y%m%d')
+
+    def _refresh(self, stock_code):
+        """从接口获取单只股票的基础资料并写入缓存"""
+        if self.scheduler:
+            stock_info_df = self.scheduler.call('stock_individual_info_em', ak.stock_individual_info_em, symbol=stock_code)
+        else:
+            stock_info_df = ak.stock_individual_info_em(symbol=stock_code)
+        items = dict(zip(stock_info_df['item'], stock_info_df['value']))
+        return self.update({stock_code: items})[stock_code]
+
+    def update(self, items_by_code):
+        """批量写入基础资料，items_by_code为{代码: {'行业':..., '总股本':..., '流通股':...}}"""
+        self._ensure_loaded()
+        trading_date = get_trading_date().strftime('%Y%m%d')
+        records = {
+            code: {
+                '行业': items.get('行业') or '未知',
+                '总股本': float(items['总股本']) if items.get('总股本') not in (None, '', '-') else None,
+                '流通股': float(items['流通股']) if items.get('流通股') not in (None, '', '-') else None,
+                '更新日期': trading_date,
+            }
+            for code, items in items_by_code.items()
+        }
+        with self.lock:
+            self.records.update(records)
+        # 落盘交给写线程与其他写入合并提交，不等待
+        rows = [(code, r['行业'], r['总股本'], r['流通股'], r['更新日期']) for code, r in records.items()]
+        self.database.submit(lambda conn: conn.executemany(UPSERT_REFERENCE_SQL, rows))
+        return records
+
+    def peek(self, stock_code):
+        """只读缓存，记录过期或不存在时返回None，不访问网络"""
+        self._ensure_loaded()
+        with self.lock:
+            record = self.records.get(stock_code)
+        return record if self._is_fresh(record) else None
+
+    def get(self, stock_code):
+        """获取股票基础资料，缓存过期（早于当前交易日）时才访问网络"""
+        self._ensure_loaded()
+        with self.lock:
+            record = self.records.get(stock_code)
+        if self._is_fresh(record):
+            return record
+        return self._refresh(stock_code)
+
+    def warm_up(self, stock_codes=None):
+        """后台预热：刷新过期的记录
+
+        stock_codes为空时只预热当天的候选股票，即最近一个交易日出现过大笔买入、且会补充行情的股票，
+        不刷新缓存中历来出现过的全部股票。并发占用调度器的名额，与正式采集共用同一上限。
+        """
+        self._ensure_loaded()
+        if stock_codes is None:
+            markets = {code: get_stock_info(code) for code, in self.database.query(
+                "SELECT DISTINCT 代码 FROM stock_changes WHERE 日期 = (SELECT MAX(日期) FROM stock_changes)")}
+            stock_codes = [code for code, (exchange, market) in markets.items()
+                           if not (exchange == 'bj' or market in ('科创板', '创业板'))]
+        with self.lock:
+            stale_codes = [code for code in stock_codes if not self._is_fresh(self.records.get(code))]
+        if not stale_codes:
+            return
+        if ak is None:
+            lazy_import_heavy_modules()
+        logging.info(f"开始预热股票基础资料: {len(stale_codes)} 只")
+
+        def refresh(code):
+            try:
+                if self.scheduler:
+                    with self.scheduler.slot():
+                        self._refresh(code)
+                else:
+                    self._refresh(code)
+            except Exception as e:
+                logging.error(f"预热股票 {code} 基础资料失败: {e}")
+
+        max_workers = min(self.scheduler.max_concurrency if self.scheduler else 1, len(stale_codes))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ReferenceWarmUp") as executor:
+            list(executor.map(refresh, stale_codes))
+        logging.info("股票基础资料预热完成")
+
+
+class MinuteBarCache:
+    """1分钟K线本地缓存：已收盘的交易日直接读库，盘中只补拉最后一根缓存K线之后的数据"""
+
+    # 收盘后留出几分钟等最后一根K线落定，之后拉到的数据视为完整
+    SESSION_CLOSE_TIME = "15:05"
+
+    def __init__(self, database, scheduler=None):
+        self.database = database
+        self.scheduler = scheduler
+
+    def get_day(self, stock_code, trading_date, adjust="qfq"):
+        """返回某个交易日的1分钟K线，列名与ak.stock_zh_a_hist_min_em一致"""
+        date = trading_date.strftime('%Y%m%d')
+        day = trading_date.strftime('%Y-%m-%d')
+        session = self.database.query(
+            "SELECT 最后时间, 已收盘 FROM minute_bar_sessions WHERE 代码 = ? AND 日期 = ? AND 复权 = ?",
+            (stock_code, date, adjust)
+        )
+        last_time, closed = session[0] if session else (None, 0)
+        # 旧版本会把拉取为空的日期记为已收盘（最后时间为空），这类记录仍重新请求
+        if not closed or last_time is None:
+            self._top_up(stock_code, trading_date, adjust, last_time)
+        else:
+            logging.info(f"{stock_code} {day} 的1分钟K线已在本地缓存中")
+        return self.database.query_frame(
+            f"SELECT {', '.join(MINUTE_BAR_COLUMNS)} FROM minute_bars WHERE 代码 = ? AND 日期 = ? AND 复权 = ? ORDER BY 时间",
+            (stock_code, date, adjust)
+        )
+
+    def get_days(self, stock_code, end_date, days, adjust="qfq"):
+        """返回截至end_date最近days个交易日的1分钟K线，按时间升序，节假日没有数据自动跳过"""
+        frames = []
+        trading_date = end_date
+        # 最多往前多看几个工作日，长假或超出数据源保留范围时停止
+        for _ in range(days + 5):
+            if len(frames) == days:
+                break
+            frame = self.get_day(stock_code, trading_date, adjust)
+            if not frame.empty:
+                frames.append(frame)
+            trading_date = trading_date - timedelta(days=1)
+            while trading_date.weekday() > 4:
+                trading_date = trading_date - timedelta(days=1)
+        if not frames:
+            return pd.DataFrame(columns=MINUTE_BAR_COLUMNS)
+        return pd.concat(frames[::-1], ignore_index=True)
+
+    def get_many(self, stock_codes, trading_date, adjust="qfq", max_workers=8):
+        """批量获取多只股票某个交易日的1分钟K线，返回{代码: DataFrame}；并发数有上限，单只失败记为空表"""
+        frames = {}
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="MinuteBars") as executor:
+            futures = {executor.submit(self.get_day, code, trading_date, adjust): code for code in stock_codes}
+            for future in as_completed(futures):
+                code = futures[future]
+                try:
+                    frames[code] = future.result()
+                except Exception as e:
+                    logging.error(f"获取 {code} 的1分钟K线失败: {e}")
+                    frames[code] = pd.DataFrame(columns=MINUTE_BAR_COLUMNS)
+        return frames
+
+    def _top_up(self, stock_code, trading_date, adjust, last_time):
+        """从最后一根缓存K线（含，盘中它可能尚未走完）开始补拉到收盘"""
+        now = datetime.now()
+        day = trading_date.strftime('%Y-%m-%d')
+        session_closed = trading_date.date() < now.date() or now.strftime('%H:%M') >= self.SESSION_CLOSE_TIME
+        start_date = last_time or f"{day} 09:00:00"
+        kwargs = dict(symbol=stock_code, period="1", start_date=start_date, end_date=f"{day} 15:00:00", adjust=adjust)
+        if self.scheduler:
+            bars = self.scheduler.call('stock_zh_a_hist_min_em', ak.stock_zh_a_hist_min_em, **kwargs)
+        else:
+            bars = ak.stock_zh_a_hist_min_em(**kwargs)
+        date = trading_date.strftime('%Y%m%d')
+        if bars.empty:
+            # 拉不到数据可能只是数据源暂时返回空表，不记为已收盘，下次仍会请求
+            return
+
+        bars = bars.reindex(columns=MINUTE_BAR_COLUMNS)
+        bars['时间'] = pd.to_datetime(bars['时间']).dt.strftime('%Y-%m-%d %H:%M:%S')
+        bars = bars[bars['时间'] >= start_date]
+        rows = [(stock_code, date, adjust) + row for row in sql_rows(bars, MINUTE_BAR_COLUMNS)]
+        new_last_time = max(last_time or '', bars['时间'].max()) if not bars.empty else last_time
+
+        def write(conn):
+            conn.executemany(INSERT_MINUTE_BAR_SQL, rows)
+            conn.execute(
+                "INSERT OR REPLACE INTO minute_bar_sessions (代码, 日期, 复权, 最后时间, 已收盘) VALUES (?, ?, ?, ?, ?)",
+                (stock_code, date, adjust, new_last_time, int(session_closed and new_last_time is not None))
+            )
+
+        self.database.write(write)
+        logging.info(f"{stock_code} {day} 补充 {len(rows)} 根1分钟K线，最后时间 {new_last_time}")
+
+
+class FundFlowCache:
+    """个股资金流本地缓存，按(代码, 日期)存储
+
+    历史日期的数据不会再变，永久保留；当日数据盘中会变，距上次获取超过ttl才重新请求，
+    收盘后获取的视为当日最终数据。prefetch在后台为一批股票预热缓存。
+    """
+
+    def __init__(self, database, scheduler=None, ttl=120, max_workers=2):
+        self.database = database
+        self.scheduler = scheduler
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="FundFlow")
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def get(self, stock_code, days=None):
+        """返回资金流，按日期升序，列名与ak.stock_individual_fund_flow一致；days给定时只取最近days天"""
+        if not self.is_fresh(stock_code):
+            self._fetch(stock_code)
+        else:
+            logging.info(f"{stock_code} 的资金流已在本地缓存中")
+        sql = f"SELECT {FUND_FLOW_SELECT} FROM fund_flow WHERE 代码 = ? ORDER BY 日期 DESC"
+        params = (stock_code,)
+        if days:
+            sql += " LIMIT ?"
+            params += (days,)
+        return self.database.query_frame(sql, params).iloc[::-1].reset_index(drop=True)
+
+    def is_fresh(self, stock_code, now=None):
+        """当前交易日收盘后获取过，或距上次获取不到ttl秒"""
+        now = now or datetime.now()
+        rows = self.database.query("SELECT 更新时间 FROM fund_flow_fetches WHERE 代码 = ?", (stock_code,))
+        if not rows:
+            return False
+        fetched_at = datetime.strptime(rows[0][0], '%Y-%m-%d %H:%M:%S')
+        session_close = datetime.strptime(
+            f"{get_trading_date(now).strftime('%Y-%m-%d')} {MinuteBarCache.SESSION_CLOSE_TIME}", '%Y-%m-%d %H:%M'
+        )
+        return fetched_at >= session_close or (now - fetched_at).total_seconds() < self.ttl
+
+    def prefetch(self, stock_codes):
+        """在后台为stock_codes预热缓存，正在获取的跳过，缓存仍有效的不请求"""
+        for stock_code in stock_codes:
+            with self.lock:
+                if stock_code in self.pending:
+                    continue
+                self.pending.add(stock_code)
+            self.executor.submit(self._prefetch_one, stock_code)
+
+    def _prefetch_one(self, stock_code):
+        try:
+            if not self.is_fresh(stock_code):
+                self._fetch(stock_code)
+        except Exception as e:
+            logging.warning(f"预取 {stock_code} 的资金流失败: {e}")
+        finally:
+            with self.lock:
+                self.pending.discard(stock_code)
+
+    def _fetch(self, stock_code):
+        """请求全部历史资金流并写库，已有日期的数据整行替换"""
+        exchange, _ = get_stock_info(stock_code)
+        market = exchange if exchange in ('sh', 'sz', 'bj') else 'sh'
+        if self.scheduler:
+            frame = self.scheduler.call('stock_individual_fund_flow', ak.stock_individual_fund_flow, stock=stock_code, market=market)
+        else:
+            frame = ak.stock_individual_fund_flow(stock=stock_code, market=market)
+        fetched_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        frame = frame.reindex(columns=FUND_FLOW_COLUMNS)
+        frame['日期'] = pd.to_datetime(frame['日期']).dt.strftime('%Y-%m-%d')
+        rows = [(stock_code,) + row for row in sql_rows(frame, FUND_FLOW_COLUMNS)]
+
+        def write(conn):
+            conn.executemany(INSERT_FUND_FLOW_SQL, rows)
+            conn.execute("INSERT OR REPLACE INTO fund_flow_fetches (代码, 更新时间) VALUES (?, ?)", (stock_code, fetched_at))
+
+        self.database.write(write)
+        logging.info(f"{stock_code} 资金流更新 {len(rows)} 天")
+
+
+class BigBuyIndex:
+    """大笔买入明细索引的读取端：按(日期, 代码)取入库时打包好的数组，解包结果在内存中按LRU保留
+
+    每次读取先查笔数，笔数没变直接复用内存中的数组；索引里没有的股票（尚未迁移的旧数据）从stock_changes现场分组。
+    """
+
+    def __init__(self, database, max_entries=200):
+        self.database = database
+        self.max_entries = max_entries
+        # (日期, 代码) → (笔数, (名称, 板块, {字段: 数组}))
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, date, stock_code):
+        """返回(名称, 板块, {字段: 数组})，数组按时间升序；没有记录时返回None"""
+        key = (date, stock_code)
+        rows = self.database.query("SELECT 笔数 FROM big_buy_index WHERE 日期 = ? AND 代码 = ?", key)
+        with self.lock:
+            cached = self.entries.get(key)
+            if rows and cached and cached[0] == rows[0][0]:
+                self.entries.move_to_end(key)
+                return cached[1]
+
+        if rows:
+            name, board, count, data = self.database.query(
+                "SELECT 名称, 板块, 笔数, 数据 FROM big_buy_index WHERE 日期 = ? AND 代码 = ?", key)[0]
+        else:
+            packed = pack_big_buy_events(self.database.query_frame(
+                f"SELECT {', '.join(BIG_BUY_COLUMNS)} FROM stock_changes WHERE 日期 = ? AND 代码 = ? ORDER BY 时间", key))
+            if not packed:
+                return None
+            _, name, board, count, data = packed[0]
+        entry = (name, board, unpack_big_buy_events(data))
+
+        with self.lock:
+            self.entries[key] = (count, entry)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def minute_histogram(events):
+        """按交易分钟汇总大笔买入金额，返回长度为SESSION_MINUTES的数组，第i个元素对应距开盘第i+1分钟"""
+        slots = clock_session_minutes(events['秒'] // 60) - 1
+        return np.bincount(slots, weights=np.nan_to_num(events['成交金额']), minlength=SESSION_MINUTES)
+
+
+class FundFlowRankSource:
+    """主表资金流排名列：每个统计周期一次请求全市场排名，按代码一次合并进主表，不逐只请求
+
+    结果在内存中保留ttl秒；refresh在后台获取过期的周期，完成后经ProgressBus在界面线程回调。
+    """
+
+    def __init__(self, bus, scheduler=None, ttl=30):
+        self.bus = bus
+        self.scheduler = scheduler
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="FundFlowRank")
+        # indicator → (获取时间, 以代码为索引的净流入Series)
+        self.series = {}
+        self.pending = set()
+
+    def join(self, frame, columns):
+        """把已获取的排名列按代码左连接到frame，未获取的列不加"""
+        loaded = {column: self.series[FUND_FLOW_RANK_COLUMNS[column][0]][1]
+                  for column in columns if column in FUND_FLOW_RANK_COLUMNS and FUND_FLOW_RANK_COLUMNS[column][0] in self.series}
+        if not loaded:
+            return frame
+        return frame.join(pd.DataFrame(loaded), on='代码')
+
+    def refresh(self, columns, callback):
+        """后台获取columns中过期的周期，有新数据时在界面线程调用callback()"""
+        now = time.monotonic()
+        indicators = {
+            FUND_FLOW_RANK_COLUMNS[column][0] for column in columns if column in FUND_FLOW_RANK_COLUMNS
+        }
+        stale = [indicator for indicator in indicators
+                 if indicator not in self.pending and now - self.series.get(indicator, (-self.ttl, None))[0] >= self.ttl]
+        if not stale:
+            return
+        self.pending.update(stale)
+        future = self.executor.submit(self._fetch, stale)
+        future.add_done_callback(lambda done: self.bus.call_soon(self._on_fetched, done, callback))
+
+    def _fetch(self, indicators):
+        fetched = {}
+        # indicator → 排名表中的源字段，以FUND_FLOW_RANK_COLUMNS的声明为准
+        sources = dict(FUND_FLOW_RANK_COLUMNS.values())
+        for indicator in indicators:
+            try:
+                if self.scheduler:
+                    rank = self.scheduler.call('stock_individual_fund_flow_rank', ak.stock_individual_fund_flow_rank, indicator=indicator)
+                else:
+                    rank = ak.stock_individual_fund_flow_rank(indicator=indicator)
+                values = (pd.to_numeric(rank[sources[indicator]], errors='coerce') / 10000).round(1)
+                series = pd.Series(values.to_numpy(), index=rank['代码'].astype(str))
+                fetched[indicator] = (time.monotonic(), series[~series.index.duplicated()])
+                logging.info(f"获取{indicator}资金流排名 {len(rank)} 只股票")
+            except Exception as e:
+                logging.error(f"获取{indicator}资金流排名失败: {e}")
+        return indicators, fetched
+
+    def _on_fetched(self, future, callback):
+        indicators, fetched = future.result()
+        self.pending.difference_update(indicators)
+        self.series.update(fetched)
+        if fetched:
+            callback()
+
+
+class AsyncEnrichmentEngine:
+    """asyncio个股补充引擎：共享keep-alive的httpx.AsyncClient连接池，并发数有上限
+
+    东财个股接口一次请求即可同时返回行情和基础资料（行业、总股本、流通股），
+    快照中已有行情且基础资料未过期的股票不发请求。
+    """
+
+    QUOTE_URL = "https://push2.eastmoney.com/api/qt/stock/get"
+    # 东财字段编号到stock_real_data/stock_reference字段的映射
+    QUOTE_FIELDS = {
+        'f43': '最新',
+        'f170': '涨幅',
+        'f46': '今开',
+        'f44': '最高',
+        'f45': '最低',
+        'f51': '涨停',
+        'f168': '换手',
+        'f50': '量比',
+        'f127': '行业',
+        'f84': '总股本',
+        'f85': '流通股',
+    }
+
+    def __init__(self, reference=None, max_concurrency=50, timeout=10, max_retries=2, backoff_base=0.5):
+        self.reference = reference
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+
+    def enrich(self, stock_rows, quotes=None, on_result=None):
+        """在当前线程运行事件循环，stock_rows为[(代码, 名称)]，返回与process_stock相同结构的记录列表
+
+        on_result(代码, 名称, 记录, 异常)在每只股票完成时调用，失败时记录为None；未提供时失败写入日志。
+        """
+        return asyncio.run(self._enrich_all(stock_rows, quotes or {}, on_result))
+
+    async def _enrich_all(self, stock_rows, quotes, on_result):
+        import httpx
+
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        fetched_reference = {}
+        records = []
+        async with httpx.AsyncClient(limits=limits, timeout=self.timeout, headers={'User-Agent': 'Mozilla/5.0'}) as client:
+            tasks = [
+                self._enrich_one(client, semaphore, stock_code, stock_name, quotes.get(stock_code), fetched_reference)
+                for stock_code, stock_name in stock_rows
+            ]
+            for task in asyncio.as_completed(tasks):
+                stock_code, stock_name, record, error = await task
+                if record is not None:
+                    records.append(record)
+                if on_result:
+                    on_result(stock_code, stock_name, record, error)
+                elif error is not None:
+                    logging.error(f"处理股票代码 {stock_code} ({stock_name}) 时出错: {error}")
+
+        # 顺带取得的基础资料批量写回缓存
+        if fetched_reference and self.reference is not None:
+            self.reference.update(fetched_reference)
+        return records
+
+    async def _enrich_one(self, client, semaphore, stock_code, stock_name, quote, fetched_reference):
+        try:
+            reference = self.reference.peek(stock_code) if self.reference is not None else None
+            if quote is None or reference is None:
+                async with semaphore:
+                    data = await self._fetch_quote(client, stock_code)
+                fetched_reference[stock_code] = {'行业': data['行业'], '总股本': data['总股本'], '流通股': data['流通股']}
+                reference = reference or fetched_reference[stock_code]
+                quote = quote or data
+            return stock_code, stock_name, build_real_data_record(stock_code, stock_name, reference, quote), None
+        except Exception as e:
+            return stock_code, stock_name, None, e
+
+    async def _fetch_quote(self, client, stock_code):
+        """请求东财个股接口，瞬时错误按指数退避加随机抖动重试"""
+        params = {
+            'fltt': '2',
+            'invt': '2',
+            'fields': ','.join(self.QUOTE_FIELDS),
+            'secid': f"{1 if stock_code.startswith('6') else 0}.{stock_code}",
+        }
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await client.get(self.QUOTE_URL, params=params)
+                response.raise_for_status()
+                data = response.json().get('data')
+                break
+            except Exception as e:
+                if attempt >= self.max_retries or not is_transient_error(e):
+                    raise
+                await asyncio.sleep(random.uniform(0, self.backoff_base * 2 ** attempt))
+        if not data:
+            raise ValueError(f"接口未返回 {stock_code} 的数据")
+
+        result = {}
+        for field, name in self.QUOTE_FIELDS.items():
+            value = data.get(field)
+            if name == '行业':
+                result[name] = value if value not in (None, '', '-') else '未知'
+            else:
+                result[name] = float(value) if value not in (None, '', '-') else None
+        return result
+
+
+class ProgressBus:
+    """进度事件通道：工作线程只发布事件不接触Tk，界面按固定节拍取出并合并成一次刷新
+
+    事件在发布时统一写日志，界面和日志共用同一来源；buffered为False时只写日志（守护进程使用）。
+    """
+
+    def __init__(self, buffered=True):
+        self.buffered = buffered
+        self.events = queue.Queue()
+
+    def publish(self, kind, **data):
+        event = dict(data, kind=kind)
+        if kind == 'status':
+            logging.info(event['text'])
+        elif kind == 'timing':
+            logging.info(f"阶段耗时 {event['stage']}: {event['seconds']:.2f}s")
+        elif kind == 'failure':
+            logging.error(f"处理股票 {event['code']}({event['name']}) 时出错: {event['error']}")
+        if self.buffered:
+            self.events.put(event)
+
+    def status(self, text):
+        self.publish('status', text=text)
+
+    def progress(self, processed, failed, total):
+        self.publish('progress', processed=processed, failed=failed, total=total)
+
+    def timing(self, stage, seconds):
+        self.publish('timing', stage=stage, seconds=seconds)
+
+    def failure(self, code, name, error):
+        self.publish('failure', code=code, name=name, error=str(error))
+
+    def call_soon(self, callback, *args):
+        """在界面线程的下一个节拍调用callback(*args)，工作线程由此把结果交回界面"""
+        self.publish('callback', callback=callback, args=args)
+
+    def drain(self):
+        """取出当前积压的全部事件"""
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+
+class IngestPipeline:
+    """无界面的数据采集流水线：拉取大笔买入事件、补充个股行情、写入stock_changes/stock_real_data表
+
+    界面和ingest守护进程共用，状态、进度、阶段耗时和失败都发布到ProgressBus，不依赖Tk。
+    """
+
+    def __init__(self, scheduler, reference, database):
+        self.scheduler = scheduler
+        self.reference = reference
+        self.database = database
+
+    @contextmanager
+    def _stage(self, bus, timings, name):
+        """记录一个阶段的耗时并发布"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            timings[name] = time.monotonic() - start
+            bus.timing(name, timings[name])
+
+    def fetch_events(self):
+        """拉取当天的大笔买入事件并拆分相关信息字段"""
+        stock_changes_em_df = self.scheduler.call('stock_changes_em', ak.stock_changes_em, symbol="大笔买入")
+        # 集合竞价期间接口可能没有数据，此时返回空表，拆分字段会因列数不符报错
+        if '相关信息' in stock_changes_em_df:
+            stock_changes_em_df = stock_changes_em_df.dropna(subset=['相关信息'])
+        if stock_changes_em_df.empty or '相关信息' not in stock_changes_em_df:
+            return pd.DataFrame({col: pd.Series(dtype='datetime64[ns]' if col == '时间' else object) for col in BIG_BUY_COLUMNS})
+        split_info = stock_changes_em_df['相关信息'].str.split(',', expand=True)
+        split_info.columns = ['成交量', '成交价', '占成交量比', '成交金额']
+        split_info['成交量'] = pd.to_numeric(split_info['成交量'], errors='coerce')
+        split_info['成交价'] = pd.to_numeric(split_info['成交价'], errors='coerce')
+        split_info['占成交量比'] = pd.to_numeric(split_info['占成交量比'], errors='coerce')
+        split_info['成交金额'] = pd.to_numeric(split_info['成交金额'], errors='coerce')
+        stock_changes_em_df = pd.concat([stock_changes_em_df.drop(columns=['相关信息']), split_info], axis=1)
+        current_date_obj = datetime.now().date()
+        stock_changes_em_df['时间'] = pd.to_datetime(
+            current_date_obj.strftime('%Y-%m-%d') + ' ' + stock_changes_em_df['时间'].apply(lambda x: x.strftime('%H:%M:%S')),
+            format='%Y-%m-%d %H:%M:%S'
+        )
+        return stock_changes_em_df
+
+    def run_cycle(self, bus=None):
+        """运行一轮采集，返回本轮统计和各阶段耗时，bus为空时事件只写日志"""
+        bus = bus or ProgressBus(buffered=False)
+        settings = load_settings()
+        ingest_mode = settings.get("ingest_mode", "incremental")
+        current_date = datetime.now().strftime('%Y%m%d')
+        timings = {}
+        result = {'new_events': 0, 'changed_codes': set(), 'total_stocks': 0, 'successful': 0, 'failed': 0, 'timings': timings}
+        cycle_start = time.monotonic()
+
+        bus.status("正在获取大笔买入数据...")
+        with self._stage(bus, timings, '拉取事件'):
+            stock_changes_em_df = self.fetch_events()
+
+        try:
+            if stock_changes_em_df.empty:
+                bus.status("暂无大笔买入数据")
+                return result
+
+            bus.status("正在保存大笔买入数据到数据库...")
+            with self._stage(bus, timings, '事件入库'):
+                new_count, changed_codes = self.database.write(ingest_big_buy_events, stock_changes_em_df, current_date, ingest_mode)
+            logging.info(f"数据已成功存入 SQLite 数据库表 stock_changes！新增 {new_count} 条记录，涉及 {len(changed_codes)} 只股票")
+            result['new_events'] = new_count
+            result['changed_codes'] = changed_codes
+
+            # 准备处理股票实时数据
+            stock_info = stock_changes_em_df[['代码', '名称']].drop_duplicates(subset=['代码'])
+
+            def not_bj_kcb(row):
+                exchange, market = get_stock_info(row['代码'])
+                return not (exchange == 'bj' or market == '科创板' or market == '创业板')
+
+            filtered_stock_info = stock_info[stock_info.apply(not_bj_kcb, axis=1)]
+
+            # 增量模式下只补充有新事件或尚无实时数据的股票
+            enriched_codes = {row[0] for row in self.database.query("SELECT 代码 FROM stock_real_data WHERE 日期 = ?", (current_date,))}
+            incremental_real_data = ingest_mode == "incremental" and bool(enriched_codes)
+            if incremental_real_data:
+                pending = filtered_stock_info['代码'].isin(changed_codes) | ~filtered_stock_info['代码'].isin(enriched_codes)
+                filtered_stock_info = filtered_stock_info[pending]
+
+            total_stocks = len(filtered_stock_info)
+            result['total_stocks'] = total_stocks
+            if total_stocks == 0:
+                return result
+
+            # 快照模式下一次性获取全市场行情，快照中缺失的股票回退到逐只获取盘口
+            spot_quotes = {}
+            if settings.get("enrich_mode", "snapshot") == "snapshot":
+                bus.status("正在获取全市场实时行情快照...")
+                with self._stage(bus, timings, '行情快照'):
+                    try:
+                        spot_quotes = build_spot_quotes(filtered_stock_info, self.scheduler.call('stock_zh_a_spot_em', fetch_spot_snapshot))
+                        logging.info(f"行情快照覆盖 {len(spot_quotes)}/{total_stocks} 只股票")
+                    except Exception as e:
+                        logging.error(f"获取行情快照失败，回退到逐只获取: {e}")
+
+            bus.status(f"开始获取 {total_stocks} 只股票的实时数据...")
+            with self._stage(bus, timings, '个股补充'):
+                real_data_list = self.enrich(filtered_stock_info, spot_quotes, settings, bus)
+            result['successful'] = len(real_data_list)
+            result['failed'] = total_stocks - len(real_data_list)
+            logging.info(f"抓取调度统计: {self.scheduler.format_stats()}")
+            bus.status(f"股票数据获取完成！成功: {len(real_data_list)}/{total_stocks} 只股票")
+
+            if not real_data_list:
+                return result
+
+            bus.status("正在保存股票实时数据到数据库...")
+            with self._stage(bus, timings, '写入行情'):
+                self.database.write(write_real_data, current_date, real_data_list, incremental_real_data)
+            logging.info("实时数据已成功存入 SQLite 数据库表 stock_real_data！")
+            return result
+        finally:
+            timings['总计'] = time.monotonic() - cycle_start
+            bus.timing('总计', timings['总计'])
+
+    def enrich(self, filtered_stock_info, spot_quotes, settings, bus):
+        """补充个股行情，返回stock_real_data记录列表"""
+        total_stocks = len(filtered_stock_info)
+        progress = {'processed': 0, 'failed': 0}
+        progress_lock = threading.Lock()
+
+        def report(stock_code, stock_name, record, error=None):
+            """每完成一只股票发布一次进度，失败时同时发布失败事件"""
+            if error is not None:
+                bus.failure(stock_code, stock_name, error)
+            with progress_lock:
+                progress['processed'] += 1
+                if record is None:
+                    progress['failed'] += 1
+                processed, failed = progress['processed'], progress['failed']
+            bus.progress(processed, failed, total_stocks)
+
+        if settings.get("enrich_engine", "threads") == "asyncio":
+            engine = AsyncEnrichmentEngine(reference=self.reference, **settings.get("async_engine", {}))
+            stock_rows = list(zip(filtered_stock_info['代码'], filtered_stock_info['名称']))
+            return engine.enrich(stock_rows, spot_quotes, report)
+
+        def process_stock_with_progress(stock_code, stock_name):
+            """带进度更新的process_stock包装函数"""
+            try:
+                with self.scheduler.slot():
+                    record = self.process_stock(stock_code, stock_name, spot_quotes.get(stock_code))
+            except Exception as e:
+                report(stock_code, stock_name, None, e)
+                return None
+            report(stock_code, stock_name, record)
+            return record
+
+        real_data_list = []
+        # 实际并发由调度器的AIMD控制，线程数只是上限
+        max_workers = min(self.scheduler.max_concurrency, total_stocks)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # 创建future到股票代码的映射
+            future_to_stock = {
+                executor.submit(process_stock_with_progress, row['代码'], row['名称']): (row['代码'], row['名称'])
+                for _, row in filtered_stock_info.iterrows()
+            }
+
+            # 处理完成的任务
+            for future in as_completed(future_to_stock):
+                stock_code, stock_name = future_to_stock[future]
+                try:
+                    record = future.result()
+                    if record:
+                        real_data_list.append(record)
+                except Exception as e:
+                    logging.error(f"获取股票 {stock_code}({stock_name}) 结果时出错: {e}")
+        return real_data_list
+
+    def process_stock(self, stock_code, stock_name, quote=None):
+        """获取单只股票的行业和实时行情，quote为全市场快照中该股的行情（为空时逐只调用盘口接口），失败时抛出异常"""
+        # 行业和总股本取自每日刷新一次的基础资料缓存，总市值由总股本×最新价推算
+        reference = self.reference.get(stock_code)
+        if quote is None:
+            stock_bid_ask_df = self.scheduler.call('stock_bid_ask_em', ak.stock_bid_ask_em, symbol=stock_code)
+            latest_price = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '最新']['value'].iloc[0]) if '最新' in stock_bid_ask_df['item'].values else None
+            price_change_percent = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '涨幅']['value'].iloc[0]) if '涨幅' in stock_bid_ask_df[
+                'item'].values else None
+            opening_price = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '今开']['value'].iloc[0]) if '今开' in stock_bid_ask_df['item'].values else None
+
+            turnover_rate = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '换手']['value'].iloc[0]) if '换手' in stock_bid_ask_df['item'].values else None
+            volume_ratio = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '量比']['value'].iloc[0]) if '量比' in stock_bid_ask_df['item'].values else None
+
+            max_price = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '最高']['value'].iloc[0]) if '最高' in stock_bid_ask_df['item'].values else None
+            min_price = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '最低']['value'].iloc[0]) if '最低' in stock_bid_ask_df['item'].values else None
+            zhang_ting = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '涨停']['value'].iloc[0]) if '涨停' in stock_bid_ask_df['item'].values else None
+            quote = {
+                '最新': latest_price,
+                '涨幅': price_change_percent,
+                '最高': max_price,
+                '最低': min_price,
+                '涨停': zhang_ting,
+                '换手': turnover_rate,
+                '量比': volume_ratio,
+                '今开': opening_price
+            }
+        return build_real_data_record(stock_code, stock_name, reference, quote)
+
+
+def is_trading_time(now=None):
+    """是否处于A股交易时段（含集合竞价）"""
+    now = now or datetime.now()
+    if now.weekday() > 4:
+        return False
+    current_time = now.strftime('%H:%M')
+    return '09:15' <= current_time <= '11:30' or '13:00' <= current_time <= '15:00'
+
+
+def run_ingest_daemon(interval=30, once=False):
+    """无界面采集：交易时段内每interval秒运行一轮采集流水线，once时立即运行一轮后退出"""
+    ensure_config_file()
+    lazy_import_heavy_modules()
+    scheduler = FetchScheduler(**load_settings().get("fetch_scheduler", {}))
+    database = StockDatabase()
+    reference = StockReferenceCache(database, scheduler=scheduler)
+    pipeline = IngestPipeline(scheduler, reference, database)
+    logging.info(f"采集守护进程启动，间隔 {interval} 秒")
+
+    while True:
+        cycle_start = time.monotonic()
+        if once or is_trading_time():
+            try:
+                result = pipeline.run_cycle()
+                logging.info(f"本轮采集完成：新增事件 {result['new_events']} 条，补充股票 {result['successful']}/{result['total_stocks']} 只，"
+                             f"总耗时 {result['timings']['总计']:.2f}s")
+            except Exception as e:
+                logging.error(f"本轮采集失败: {e}")
+        else:
+            logging.info("非交易时段，等待下一轮")
+        if once:
+            # 等待基础资料等排队中的写入提交
+            database.close()
+            return
+        time.sleep(max(0, interval - (time.monotonic() - cycle_start)))
+
+
+class ScreeningDataset:
+    """当日主界面数据的内存列存，阈值筛选和排序用NumPy掩码和argsort完成，不访问数据库"""
+
+    def __init__(self, frame):
+        self.columns = list(frame.columns)
+        self.size = len(frame)
+        self.arrays = {col: frame[col].to_numpy() for col in self.columns}
+        # 数值列另存一份float数组，缺失值为NaN
+        self.numeric = {
+            col: pd.to_numeric(frame[col], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+            for col in self.columns if col in SCREENING_NUMERIC_COLUMNS or pd.api.types.is_numeric_dtype(frame[col])
+        }
+        # 整列排序下标按(列, 是否降序)缓存，数据变化时随数据集整体重建
+        self.sort_orders = {}
+
+    def sort_order(self, column, descending=True):
+        """整列的排序下标：缺失值总在最后，相同值保持代码顺序（与SQLite的ORDER BY结果一致）"""
+        key = (column, descending)
+        if key not in self.sort_orders:
+            if column in self.numeric:
+                keys = self.numeric[column]
+            else:
+                # 文本列先转成排名再按数值排序
+                text = pd.Series(self.arrays[column])
+                keys = np.unique(text.fillna('').astype(str).to_numpy(), return_inverse=True)[1].astype(float)
+                keys[text.isna().to_numpy()] = np.nan
+            keys = -keys if descending else keys
+            self.sort_orders[key] = np.argsort(np.where(np.isnan(keys), np.inf, keys), kind='stable')
+        return self.sort_orders[key]
+
+    def select(self, min_amount, min_market_cap, sort_by, descending=True):
+        """按总成交金额(万) > min_amount、总市值(亿) >= min_market_cap筛选，按sort_by排序返回DataFrame"""
+        if self.size == 0:
+            return pd.DataFrame(columns=self.columns)
+        mask = (self.numeric['总市值'] >= min_market_cap) & (self.numeric['总成交金额'] > min_amount)
+        if sort_by in self.arrays:
+            order = self.sort_order(sort_by, descending)
+            indices = order[mask[order]]
+        else:
+            indices = np.flatnonzero(mask)
+        return pd.DataFrame({col: self.arrays[col][indices] for col in self.columns})
+
+
+class IndicatorState:
+    """指标引擎的承接状态：最近若干根K线的环形缓冲和各指标的累加量，大小与K线总数无关"""
+
+    def __init__(self, closes, highs, lows, gains, losses, count, sums, square_sum, gain_sum, loss_sum,
+                 ema_fast, ema_slow, dea, k, d):
+        self.closes = closes
+        self.highs = highs
+        self.lows = lows
+        self.gains = gains
+        self.losses = losses
+        self.pos = 0
+        self.count = count
+        self.sums = sums
+        self.square_sum = square_sum
+        self.gain_sum = gain_sum
+        self.loss_sum = loss_sum
+        self.ema_fast = ema_fast
+        self.ema_slow = ema_slow
+        self.dea = dea
+        self.k = k
+        self.d = d
+        # 推进最后一根K线之前的状态，盘中最后一根K线更新时据此重算
+        self.previous = None
+
+    def copy(self):
+        state = IndicatorState(
+            self.closes.copy(), self.highs.copy(), self.lows.copy(), self.gains.copy(), self.losses.copy(), self.count,
+            {n: value.copy() for n, value in self.sums.items()}, self.square_sum.copy(), self.gain_sum.copy(),
+            self.loss_sum.copy(), self.ema_fast.copy(), self.ema_slow.copy(), self.dea.copy(), self.k.copy(), self.d.copy()
+        )
+        state.pos = self.pos
+        return state
+
+
+class IndicatorEngine:
+    """技术指标引擎：MA、BOLL、RSI、MACD、KDJ
+
+    compute对整段K线一次性向量化计算，数组最后一维为时间，二维时每行一只股票，可对全部股票一起筛选；
+    同时返回承接状态，新K线到来时update由状态O(1)地推进全部指标，不重算窗口。
+    """
+
+    def __init__(self, ma_windows=(5, 10, 20), boll_window=20, boll_width=2, rsi_window=14, macd=(12, 26, 9), kdj=(9, 3, 3)):
+        self.ma_windows = tuple(ma_windows)
+        self.boll_window = boll_window
+        self.boll_width = boll_width
+        self.rsi_window = rsi_window
+        self.macd_fast, self.macd_slow, self.macd_signal = macd
+        self.kdj_window, self.kdj_k, self.kdj_d = kdj
+        self.sum_windows = sorted(set(self.ma_windows) | {boll_window})
+        self.ring_size = max(self.sum_windows + [rsi_window, self.kdj_window])
+        self.names = [f'MA{n}' for n in self.ma_windows] + ['BB_middle', 'BB_upper', 'BB_lower', 'RSI', 'DIF', 'DEA', 'MACD', 'K', 'D', 'J']
+
+    @staticmethod
+    def _rolling(values, window, func):
+        """沿时间轴的滑动窗口计算，不足一个窗口的位置为NaN"""
+        out = np.full(values.shape, np.nan)
+        if values.shape[-1] >= window:
+            out[..., window - 1:] = func(np.lib.stride_tricks.sliding_window_view(values, window, axis=-1))
+        return out
+
+    def _latest(self, state):
+        """由承接状态求最新一根K线的全部指标"""
+        result = {}
+        for n in self.ma_windows:
+            result[f'MA{n}'] = state.sums[n] / n if state.count >= n else np.full(state.k.shape, np.nan)
+        n = self.boll_window
+        if state.count >= n:
+            middle = state.sums[n] / n
+            std = np.sqrt(np.maximum(state.square_sum - state.sums[n] ** 2 / n, 0) / (n - 1))
+        else:
+            middle = std = np.full(state.k.shape, np.nan)
+        result.update(BB_middle=middle, BB_upper=middle + self.boll_width * std, BB_lower=middle - self.boll_width * std)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rsi = 100 - 100 / (1 + state.gain_sum / state.loss_sum)
+        result['RSI'] = rsi if state.count >= self.rsi_window else np.full(state.k.shape, np.nan)
+        dif = state.ema_fast - state.ema_slow
+        result.update(DIF=dif, DEA=state.dea, MACD=2 * (dif - state.dea), K=state.k, D=state.d, J=3 * state.k - 2 * state.d)
+        return result
+
+    def compute(self, high, low, close):
+        """整段计算，返回({指标名: 与输入同形状的数组}, 承接状态)"""
+        squeeze = np.ndim(close) == 1
+        high, low, close = (np.atleast_2d(np.asarray(values, dtype=float)) for values in (high, low, close))
+        stocks, bars = close.shape
+        result = {f'MA{n}': self._rolling(close, n, lambda w: w.mean(axis=-1)) for n in self.ma_windows}
+
+        middle = self._rolling(close, self.boll_window, lambda w: w.mean(axis=-1))
+        std = self._rolling(close, self.boll_window, lambda w: w.std(axis=-1, ddof=1))
+        result.update(BB_middle=middle, BB_upper=middle + self.boll_width * std, BB_lower=middle - self.boll_width * std)
+
+        # 第一根K线的涨跌记为0，与pandas的where写法一致
+        delta = np.diff(close, axis=-1, prepend=close[:, :1])
+        gains = np.where(delta > 0, delta, 0.0)
+        losses = np.where(delta < 0, -delta, 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rs = (self._rolling(gains, self.rsi_window, lambda w: w.mean(axis=-1))
+                  / self._rolling(losses, self.rsi_window, lambda w: w.mean(axis=-1)))
+        result['RSI'] = 100 - 100 / (1 + rs)
+
+        # KDJ的最高最低取不足窗口时已有的K线，前面用第一根K线补齐
+        pad = self.kdj_window - 1
+        highest = np.lib.stride_tricks.sliding_window_view(np.pad(high, ((0, 0), (pad, 0)), mode='edge'), self.kdj_window, axis=-1).max(axis=-1)
+        lowest = np.lib.stride_tricks.sliding_window_view(np.pad(low, ((0, 0), (pad, 0)), mode='edge'), self.kdj_window, axis=-1).min(axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rsv = np.where(highest > lowest, (close - lowest) / (highest - lowest) * 100, 50.0)
+
+        # EMA和K、D是递推量，沿时间逐根推进，每一步对全部股票向量化
+        alphas = (2 / (self.macd_fast + 1), 2 / (self.macd_slow + 1), 2 / (self.macd_signal + 1))
+        ema_fast = np.empty_like(close)
+        ema_slow = np.empty_like(close)
+        dea = np.empty_like(close)
+        k = np.empty_like(close)
+        d = np.empty_like(close)
+        fast = slow = close[:, 0]
+        signal = np.zeros(stocks)
+        k_value = d_value = np.full(stocks, 50.0)
+        for t in range(bars):
+            fast = alphas[0] * close[:, t] + (1 - alphas[0]) * fast
+            slow = alphas[1] * close[:, t] + (1 - alphas[1]) * slow
+            signal = fast - slow if t == 0 else alphas[2] * (fast - slow) + (1 - alphas[2]) * signal
+            k_value = ((self.kdj_k - 1) * k_value + rsv[:, t]) / self.kdj_k
+            d_value = ((self.kdj_d - 1) * d_value + k_value) / self.kdj_d
+            ema_fast[:, t], ema_slow[:, t], dea[:, t], k[:, t], d[:, t] = fast, slow, signal, k_value, d_value
+        result.update(DIF=ema_fast - ema_slow, DEA=dea, MACD=2 * (ema_fast - ema_slow - dea), K=k, D=d, J=3 * k - 2 * d)
+
+        series = dict(close=close, high=high, low=low, gains=gains, losses=losses, ema_fast=ema_fast, ema_slow=ema_slow, dea=dea, k=k, d=d)
+        state = self._state_at(series, bars)
+        # 同时保存最后一根K线之前的状态，之后的盘中更新可以直接替换最后一根（只有一根时为空状态）
+        state.previous = self._state_at(series, bars - 1) if bars > 1 else self._empty_state(stocks)
+        if squeeze:
+            result = {name: values[0] for name, values in result.items()}
+        return result, state
+
+    def _empty_state(self, stocks):
+        """还没有任何K线时的承接状态，第一次update由此推进"""
+        def ring(fill):
+            return np.full((stocks, self.ring_size), fill)
+
+        return IndicatorState(
+            ring(np.nan), ring(0.0), ring(0.0), ring(0.0), ring(0.0), 0,
+            {n: np.zeros(stocks) for n in self.sum_windows}, np.zeros(stocks), np.zeros(stocks), np.zeros(stocks),
+            np.zeros(stocks), np.zeros(stocks), np.zeros(stocks), np.full(stocks, 50.0), np.full(stocks, 50.0)
+        )
+
+    def _state_at(self, series, end):
+        """由整段计算的中间结果构造前end根K线之后的承接状态"""
+        close, high, low, gains, losses = (series[name][:, :end] for name in ('close', 'high', 'low', 'gains', 'losses'))
+        stocks = close.shape[0]
+
+        # 环形缓冲取最近ring_size根K线，按时间顺序放置，写入位置从0开始
+        def tail(values, fill):
+            ring = np.full((stocks, self.ring_size), fill) if np.ndim(fill) == 0 else np.repeat(fill[:, None], self.ring_size, axis=1)
+            count = min(end, self.ring_size)
+            ring[:, self.ring_size - count:] = values[:, end - count:]
+            return ring
+
+        return IndicatorState(
+            tail(close, np.nan), tail(high, high[:, 0]), tail(low, low[:, 0]), tail(gains, 0.0), tail(losses, 0.0), end,
+            {n: close[:, -n:].sum(axis=-1) for n in self.sum_windows}, (close[:, -self.boll_window:] ** 2).sum(axis=-1),
+            gains[:, -self.rsi_window:].sum(axis=-1), losses[:, -self.rsi_window:].sum(axis=-1),
+            *(series[name][:, end - 1] for name in ('ema_fast', 'ema_slow', 'dea', 'k', 'd'))
+        )
+
+    def update(self, state, high, low, close, replace_last=False):
+        """推进一根新K线并返回各指标的最新值；replace_last时替换最后一根（盘中尚未走完的K线）"""
+        if replace_last and state.previous is not None:
+            previous = state.previous
+            state.__dict__.update(previous.copy().__dict__)
+            state.previous = previous
+        else:
+            state.previous = state.copy()
+        high, low, close = (np.atleast_1d(np.asarray(values, dtype=float)) for values in (high, low, close))
+        size = self.ring_size
+
+        delta = close - state.closes[:, (state.pos - 1) % size] if state.count else np.zeros_like(close)
+        gain = np.where(delta > 0, delta, 0.0)
+        loss = np.where(delta < 0, -delta, 0.0)
+        for n in self.sum_windows:
+            state.sums[n] = state.sums[n] + close
+            if state.count >= n:
+                state.sums[n] = state.sums[n] - state.closes[:, (state.pos - n) % size]
+        state.square_sum = state.square_sum + close ** 2
+        if state.count >= self.boll_window:
+            state.square_sum = state.square_sum - state.closes[:, (state.pos - self.boll_window) % size] ** 2
+        state.gain_sum = state.gain_sum + gain
+        state.loss_sum = state.loss_sum + loss
+        if state.count >= self.rsi_window:
+            state.gain_sum = state.gain_sum - state.gains[:, (state.pos - self.rsi_window) % size]
+            state.loss_sum = state.loss_sum - state.losses[:, (state.pos - self.rsi_window) % size]
+
+        if state.count == 0:
+            state.highs[:] = high[:, None]
+            state.lows[:] = low[:, None]
+        state.closes[:, state.pos] = close
+        state.highs[:, state.pos] = high
+        state.lows[:, state.pos] = low
+        state.gains[:, state.pos] = gain
+        state.losses[:, state.pos] = loss
+        recent = (state.pos - np.arange(self.kdj_window)) % size
+        highest = state.highs[:, recent].max(axis=-1)
+        lowest = state.lows[:, recent].min(axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rsv = np.where(highest > lowest, (close - lowest) / (highest - lowest) * 100, 50.0)
+        state.pos = (state.pos + 1) % size
+
+        if state.count == 0:
+            state.ema_fast = state.ema_slow = close
+            state.dea = np.zeros_like(close)
+        else:
+            state.ema_fast = 2 / (self.macd_fast + 1) * close + (1 - 2 / (self.macd_fast + 1)) * state.ema_fast
+            state.ema_slow = 2 / (self.macd_slow + 1) * close + (1 - 2 / (self.macd_slow + 1)) * state.ema_slow
+            state.dea = 2 / (self.macd_signal + 1) * (state.ema_fast - state.ema_slow) + (1 - 2 / (self.macd_signal + 1)) * state.dea
+        state.k = ((self.kdj_k - 1) * state.k + rsv) / self.kdj_k
+        state.d = ((self.kdj_d - 1) * state.d + state.k) / self.kdj_d
+        state.count += 1
+        return self._latest(state)
+
+
+class DataExporter:
+    """后台导出：单线程依次写文件，内容与上次导出到同一文件时相同则跳过，结果发布到ProgressBus"""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Export")
+        self.last_hashes = {}
+
+    def submit(self, df, filename):
+        """提交导出任务，df在提交时复制一份，之后界面数据变化不影响本次导出"""
+        return self.executor.submit(self._export, df.copy(), filename)
+
+    def _export(self, df, filename):
+        try:
+            digest = content_hash(df)
+            if self.last_hashes.get(filename) == digest and os.path.exists(filename):
+                self.bus.status(f"数据未变化，跳过导出: {filename}")
+                return False
+            start_time = time.monotonic()
+            export_data(df, filename)
+            self.last_hashes[filename] = digest
+            self.bus.status(f"已导出 {len(df)} 条记录到 {filename}，耗时 {time.monotonic() - start_time:.2f}s")
+            return True
+        except Exception as e:
+            logging.error(f"导出数据失败: {e}")
+            self.bus.status(f"导出数据失败: {e}")
+            return False
+
+
+def session_minutes(times):
+    """距开盘的分钟数，午休不计：上午9:31→1…11:30→120，下午13:01→121…15:00→240，9:30集合竞价记为1"""
+    return clock_session_minutes((times.hour * 60 + times.minute).to_numpy())
+
+
+def clock_session_minutes(clock):
+    """session_minutes的数组版本，clock为当天的分钟数（时*60+分）"""
+    return np.clip(np.where(clock <= 11 * 60 + 30, clock - (9 * 60 + 30), clock - 13 * 60 + 120), 1, SESSION_MINUTES)
+
+
+def resample_bars(data, minutes):
+    """把1分钟K线按交易时段聚合成minutes分钟K线，OHLCV一次向量化完成
+
+    时间标在区间末尾（与行情软件一致，如5分钟K线09:35包含09:31~09:35），午休不计入，
+    9:30集合竞价并入第一根，跨天的数据各自按天分组。
+    """
+    bars = data[['Open', 'High', 'Low', 'Close', 'Volume']]
+    if minutes == 1 or bars.empty:
+        return bars.copy()
+
+    times = bars.index
+    elapsed = session_minutes(times)
+    bucket = (elapsed - 1) // minutes
+    days = (times.year * 10000 + times.month * 100 + times.day).to_numpy()
+    keys = days * 1000 + bucket
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)] - 1
+
+    # 区间末尾的时刻换算回时钟时间
+    end_elapsed = np.minimum((bucket[starts] + 1) * minutes, SESSION_MINUTES)
+    end_clock = np.where(end_elapsed <= 120, 9 * 60 + 30 + end_elapsed, 13 * 60 + end_elapsed - 120)
+    index = times[starts].normalize() + pd.to_timedelta(end_clock, unit='min')
+
+    opens, highs, lows, closes, volumes = (bars[column].to_numpy(dtype=float) for column in bars.columns)
+    return pd.DataFrame({
+        'Open': opens[starts],
+        'High': np.fmax.reduceat(highs, starts),
+        'Low': np.fmin.reduceat(lows, starts),
+        'Close': closes[ends],
+        'Volume': np.add.reduceat(np.nan_to_num(volumes), starts),
+    }, index=pd.DatetimeIndex(index, name=times.name))
+
+
+def lttb_indices(values, threshold):
+    """Largest-Triangle-Three-Buckets抽稀，返回保留点的下标（横坐标为序号）
+
+    首尾必留，中间每个桶保留与前一个保留点、后一个桶均值所成三角形面积最大的点，折线形状基本不变。
+    """
+    count = len(values)
+    if threshold < 3 or count <= threshold:
+        return np.arange(count)
+    values = np.asarray(values, dtype=float)
+    values = np.where(np.isnan(values), np.nanmean(values), values)
+    edges = np.linspace(1, count - 1, threshold - 1).astype(int)
+    selected = np.empty(threshold, dtype=int)
+    selected[0], selected[-1] = 0, count - 1
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x, next_y = (end + edges[i + 2] - 1) / 2, values[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = count - 1, values[-1]
+        a = selected[i]
+        x = np.arange(start, end)
+        areas = np.abs((a - next_x) * (values[start:end] - values[a]) - (a - x) * (next_y - values[a]))
+        selected[i + 1] = start + int(np.argmax(areas))
+    return selected
+
+
+def init_render_process():
+    """渲染进程初始化：只导入绘图需要的模块，不导入akshare"""
+    global matplotlib, np, pd
+    import matplotlib as matplotlib_module
+    matplotlib_module.use('Agg')
+    import numpy as np_module
+    import pandas as pd_module
+
+    matplotlib = matplotlib_module
+    np = np_module
+    pd = pd_module
+    matplotlib.rcParams['font.family'] = 'Microsoft YaHei'
+    matplotlib.rcParams['axes.unicode_minus'] = False
+
+
+def render_kline_image(data, title, session_bars, width, height, dpi=100):
+    """在渲染进程中用Agg离屏绘制K线图，返回(宽, 高, RGBA像素字节)"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    chart = KLineChart(title, session_bars, animated=False)
+    chart.figure.set_dpi(dpi)
+    chart.figure.set_size_inches(width / dpi, height / dpi)
+    canvas = FigureCanvasAgg(chart.figure)
+    chart.update(data)
+    canvas.draw()
+    width, height = canvas.get_width_height()
+    return width, height, bytes(canvas.buffer_rgba())
+
+
+class KLineChart:
+    """K线图：价格（蜡烛、均线、布林带）、成交量、RSI三个面板
+
+    只用matplotlib的Figure，不经过pyplot的图形注册表；数据更新时原地改写已有图元。
+    animated为True时数据图元不参与整图绘制，由窗口在缓存的背景上单独重绘（blit）。
+    """
+
+    PRICE_LINES = [
+        ('MA5', 'blue', 1.5, 1.0),
+        ('MA10', 'purple', 1.5, 1.0),
+        ('MA20', 'orange', 1.5, 1.0),
+        ('BB_upper', 'gray', 1, 0.7),
+        ('BB_lower', 'gray', 1, 0.7),
+    ]
+
+    def __init__(self, title, session_bars=SESSION_MINUTES, animated=True, max_points=KLINE_MAX_POINTS):
+        from matplotlib.collections import LineCollection, PolyCollection
+        from matplotlib.figure import Figure
+        from matplotlib.lines import Line2D
+        from matplotlib.ticker import FuncFormatter, MaxNLocator
+
+        self.session_bars = session_bars
+        self.max_points = max_points
+        self.labels = []
+        self.limits = None
+        self.figure = Figure(figsize=(12, 8), facecolor='white')
+        grid = self.figure.add_gridspec(3, 1, height_ratios=(3, 1, 1), hspace=0.08)
+        self.price_ax = self.figure.add_subplot(grid[0])
+        self.volume_ax = self.figure.add_subplot(grid[1], sharex=self.price_ax)
+        self.rsi_ax = self.figure.add_subplot(grid[2], sharex=self.price_ax)
+        for ax in (self.price_ax, self.volume_ax, self.rsi_ax):
+            ax.grid(True, color='lightgray', linestyle='-')
+        self.price_ax.tick_params(labelbottom=False)
+        self.volume_ax.tick_params(labelbottom=False)
+        self.price_ax.set_ylabel('价格 (元)')
+        self.volume_ax.set_ylabel('成交量')
+        self.rsi_ax.set_ylabel('RSI')
+        self.rsi_ax.set_ylim(0, 100)
+        self.rsi_ax.axhline(70, color='red', linewidth=0.8, linestyle='--', alpha=0.7)
+        self.rsi_ax.axhline(30, color='green', linewidth=0.8, linestyle='--', alpha=0.7)
+
+        # 横轴是K线序号（不留非交易时段的空白），刻度标签显示对应时间
+        self.rsi_ax.xaxis.set_major_locator(MaxNLocator(nbins=10, integer=True))
+        self.rsi_ax.xaxis.set_major_formatter(FuncFormatter(self._format_time))
+
+        # 中国习惯：红涨绿跌，颜色随数据逐根设置
+        self.wicks = LineCollection([], linewidths=1)
+        self.bodies = PolyCollection([], linewidths=0.5)
+        self.volumes = PolyCollection([], linewidths=0)
+        self.price_ax.add_collection(self.wicks)
+        self.price_ax.add_collection(self.bodies)
+        self.volume_ax.add_collection(self.volumes)
+        self.lines = {
+            name: self.price_ax.plot([], [], color=color, linewidth=width, alpha=alpha)[0]
+            for name, color, width, alpha in self.PRICE_LINES
+        }
+        self.rsi_line = self.rsi_ax.plot([], [], color='purple', linewidth=1.5)[0]
+        self.artists = [self.wicks, self.bodies, self.volumes, *self.lines.values(), self.rsi_line]
+        for artist in self.artists:
+            artist.set_animated(animated)
+
+        # 添加图例
+        legend_elements = [
+            Line2D([0], [0], color='blue', lw=1.5, label='MA5'),
+            Line2D([0], [0], color='purple', lw=1.5, label='MA10'),
+            Line2D([0], [0], color='orange', lw=1.5, label='MA20'),
+            Line2D([0], [0], color='gray', lw=1, alpha=0.7, label='布林带'),
+        ]
+        self.price_ax.legend(handles=legend_elements, loc='lower right', frameon=True,
+                             fancybox=True, shadow=True, framealpha=0.9, fontsize=10)
+        rsi_legend_elements = [
+            Line2D([0], [0], color='purple', lw=1.5, label='RSI'),
+            Line2D([0], [0], color='red', lw=0.8, linestyle='--', alpha=0.7, label='超买(70)'),
+            Line2D([0], [0], color='green', lw=0.8, linestyle='--', alpha=0.7, label='超卖(30)'),
+        ]
+        self.rsi_ax.legend(handles=rsi_legend_elements, loc='lower right', frameon=True,
+                           fancybox=True, shadow=True, framealpha=0.9, fontsize=9)
+
+        # 在图表底部添加标题
+        self.figure.suptitle(title, fontsize=14, fontweight='bold', y=0.02)
+        self.figure.subplots_adjust(left=0.07, right=0.98, top=0.97, bottom=0.1)
+
+    def _format_time(self, value, position):
+        index = int(round(value))
+        return self.labels[index] if 0 <= index < len(self.labels) else ''
+
+    @staticmethod
+    def _bars(x, bottoms, tops, half_width=0.35):
+        """每根K线一个矩形的顶点数组，形状(n, 4, 2)"""
+        left, right = x - half_width, x + half_width
+        return np.stack([
+            np.column_stack([left, bottoms]), np.column_stack([left, tops]),
+            np.column_stack([right, tops]), np.column_stack([right, bottoms]),
+        ], axis=1)
+
+    def update(self, data):
+        """用新数据改写全部图元，返回坐标范围是否变化（变化时需整图重绘，否则只需重绘数据图元）"""
+        x = np.arange(len(data), dtype=float)
+        opens, highs, lows, closes, volumes = (
+            data[column].to_numpy(dtype=float) for column in ('Open', 'High', 'Low', 'Close', 'Volume')
+        )
+        colors = np.where(closes >= opens, 'red', 'green').tolist()
+
+        self.wicks.set_segments(np.stack([np.column_stack([x, lows]), np.column_stack([x, highs])], axis=1))
+        self.wicks.set_color(colors)
+        self.bodies.set_verts(self._bars(x, np.minimum(opens, closes), np.maximum(opens, closes)))
+        self.bodies.set_facecolor(colors)
+        self.bodies.set_edgecolor(colors)
+        self.volumes.set_verts(self._bars(x, np.zeros_like(volumes), volumes))
+        self.volumes.set_facecolor(colors)
+
+        # 蜡烛和成交量是集合图元，一次绘制全部K线；折线点数过多时按收盘价做LTTB抽稀，各条线取同一组下标
+        kept = lttb_indices(closes, self.max_points)
+        for name, line in self.lines.items():
+            line.set_data(x[kept], data[name].to_numpy(dtype=float)[kept])
+        self.rsi_line.set_data(x[kept], data['RSI'].to_numpy(dtype=float)[kept])
+
+        # 跨多天时刻度带上日期
+        time_format = '%H:%M' if data.index.normalize().nunique() <= 1 else '%m-%d %H:%M'
+        self.labels = data.index.strftime(time_format).tolist()
+        return self._fit_limits(len(data), np.concatenate([lows, data['BB_lower'].to_numpy(dtype=float)]),
+                                np.concatenate([highs, data['BB_upper'].to_numpy(dtype=float)]), volumes)
+
+    def _fit_limits(self, count, lows, highs, volumes):
+        """坐标范围只在数据超出时扩展，横轴预留一整个交易日，盘中新K线大多不触发整图重绘"""
+        low, high = np.nanmin(lows), np.nanmax(highs)
+        volume_top = np.nanmax(volumes) if len(volumes) else 0
+        x_top = max(count, self.session_bars)
+        if self.limits is not None:
+            (_, current_x_top), (price_low, price_high), current_volume_top = self.limits
+            if x_top <= current_x_top and price_low <= low and high <= price_high and volume_top <= current_volume_top:
+                return False
+        pad = (high - low) * 0.05 or abs(high) * 0.01 or 1
+        self.limits = ((-1, x_top), (low - pad, high + pad), volume_top * 1.2 or 1)
+        self.price_ax.set_xlim(*self.limits[0])
+        self.price_ax.set_ylim(*self.limits[1])
+        self.volume_ax.set_ylim(0, self.limits[2])
+        return True
+
+    def draw_animated(self):
+        """只重绘数据图元"""
+        for artist in self.artists:
+            artist.axes.draw_artist(artist)
+
+
 class KLineWindow:
-    """独立的K线图窗口类"""
+    """独立的K线图窗口类，由KLineWindowManager创建和回收"""
 
-    def __init__(self, parent, stock_code, stock_name):
+    def __init__(self, parent, stock_code, stock_name, manager):
         self.parent = parent
         self.stock_code = stock_code
         self.stock_name = stock_name
+        self.manager = manager
+        self.bar_cache = manager.bar_cache
+        # 提供渲染进程池时离屏绘制，窗口只显示位图
+        self.render_pool = manager.render_pool
+        self.indicator_engine = IndicatorEngine()
+        self.indicator_state = None
         self.window = None
         self.canvas = None
-        self.result_queue = queue.Queue()
+        self.chart = None
+        self.background = None
+        self.data = None
+        self.chart_view = None
+        self.minute_data = None
+        self.minute_days = None
+        self.fetching = False
+        self.view_changed = False
+        self.chart_title = None
+        self.session_bars = None
+        self.image_label = None
+        self.photo = None
+        self.rendering = False
+        self.render_pending = False
+        self.rendered_size = None
+        self.resize_job = None
+        self.poll_job = None
+        self.closed = False
         self.window_id = str(uuid.uuid4())[:8]
 
         # 创建窗口
         self.create_window()
 
         # 在后台获取数据
-        threading.Thread(target=self.fetch_data_async, daemon=True).start()
+        self.start_fetch()
 
-        # 定期检查结果
-        self.check_result()
+        # 交易时间内定时补拉新K线
+        self.poll_job = self.window.after(LIVE_CHART_POLL_MS, self.poll_live)
 
     def create_window(self):
         """创建K线图窗口"""
@@ -183,12 +2421,31 @@ class KLineWindow:
         main_frame = ttk.Frame(self.window)
         main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
+        # 工具条
+        toolbar_frame = ttk.Frame(main_frame)
+        toolbar_frame.pack(fill=tk.X, pady=(0, 5))
+        ttk.Label(toolbar_frame, text="周期:").pack(side=tk.LEFT)
+        self.period_var = tk.StringVar(value='1分钟')
+        period_combo = ttk.Combobox(toolbar_frame, textvariable=self.period_var, values=list(KLINE_PERIODS),
+                                    state='readonly', width=8)
+        period_combo.pack(side=tk.LEFT, padx=(0, 10))
+        period_combo.bind("<<ComboboxSelected>>", self.on_view_change)
+        ttk.Label(toolbar_frame, text="范围:").pack(side=tk.LEFT)
+        self.range_var = tk.StringVar(value='当日')
+        range_combo = ttk.Combobox(toolbar_frame, textvariable=self.range_var, values=list(KLINE_RANGES),
+                                   state='readonly', width=8)
+        range_combo.pack(side=tk.LEFT, padx=(0, 10))
+        range_combo.bind("<<ComboboxSelected>>", self.on_view_change)
+        self.live_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(toolbar_frame, text="实时更新", variable=self.live_var).pack(side=tk.LEFT)
+
         # 图表容器
         self.chart_frame = ttk.Frame(main_frame)
         self.chart_frame.pack(fill=tk.BOTH, expand=True)
 
-        # 窗口关闭事件
+        # 窗口关闭事件；获得焦点时记为最近使用
         self.window.protocol("WM_DELETE_WINDOW", self.on_window_close)
+        self.window.bind("<FocusIn>", lambda event: self.manager.touch(self))
 
     def center_window(self):
         """窗口居中"""
@@ -199,217 +2456,273 @@ class KLineWindow:
         y = (self.window.winfo_screenheight() // 2) - (height // 2)
         self.window.geometry(f'{width}x{height}+{x}+{y}')
 
-    def fetch_data_async(self):
-        """异步获取K线数据"""
+    def start_fetch(self, reload=True, live=False):
+        """后台获取一次数据，同一时间只有一个获取任务；reload为False时只在日期范围变化时重新读取1分钟K线，
+        live时只补拉当前交易日"""
+        self.fetching = True
+        view = (self.period_var.get(), self.range_var.get())
+        self.manager.submit(self.on_fetch_done, self.fetch_data_async, view, reload, live)
+
+    def on_view_change(self, event=None):
+        """切换周期或范围：由已有的1分钟K线在本地重新聚合，正在获取时等本次完成后再切换"""
+        if self.fetching:
+            self.view_changed = True
+            return
+        self.start_fetch(reload=False)
+
+    def poll_live(self):
+        """实时更新开启且在交易时间内时定时补拉数据，图表原地更新"""
+        if self.live_var.get() and self.chart_view is not None and not self.fetching and is_trading_time():
+            self.start_fetch(live=True)
+        self.poll_job = self.window.after(LIVE_CHART_POLL_MS, self.poll_live)
+
+    def fetch_data_async(self, view, reload=True, live=False):
+        """在共用线程池中获取K线数据，返回结果字典"""
         try:
             # 确保模块已导入
             if ak is None:
                 lazy_import_heavy_modules()
 
-            from datetime import datetime, timedelta
-
-            # 获取交易日期逻辑
-            now = datetime.now()
-            current_time = now.time()
-            market_open_time = datetime.strptime("09:30", "%H:%M").time()
-
-            # 如果当前时间早于9:30，使用前一天的日期
-            if current_time < market_open_time:
-                target_date = now - timedelta(days=1)
-            else:
-                target_date = now
-
-            # 进一步处理周末情况
-            while target_date.weekday() > 4:  # 0-6代表周一到周日
-                target_date = target_date - timedelta(days=1)
+            period, date_range = view
+            days = KLINE_RANGES[date_range]
+            if live and self.minute_data is not None and self.minute_days == days:
+                # 实时更新只补拉当前交易日，之前的交易日（包括拉不到数据的节假日）不再请求
+                self.top_up_session()
+            elif reload or self.minute_data is None or self.minute_days != days:
+                self.load_minute_data(days)
+            if self.minute_data is None:
+                return {
+                    'success': False,
+                    'error': f"未获取到{self.stock_name}({self.stock_code})的数据，可能是非交易日或数据源问题"
+                }
 
-            today = target_date.strftime('%Y%m%d')
+            # 其他周期由1分钟K线在本地聚合，不再访问网络
+            stock_data_processed = resample_bars(self.minute_data, KLINE_PERIODS[period])
 
-            logging.info(f"[{self.window_id}] 开始获取 {self.stock_name}({self.stock_code}) 的K线数据，日期: {today}")
+            # 计算技术指标（MA、布林带、RSI、MACD、KDJ）
+            self.apply_indicators(stock_data_processed, view)
 
-            # 获取股票1分钟K线数据
-            stock_data = ak.stock_zh_a_hist_min_em(
-                symbol=self.stock_code,
-                period="1",
-                start_date=f"{today} 09:00:00",
-                end_date=f"{today} 15:00:00",
-                adjust="qfq"
-            )
+            dates = stock_data_processed.index.normalize().unique()
+            display_date = dates[0].strftime('%Y-%m-%d')
+            if len(dates) > 1:
+                display_date += f"~{dates[-1].strftime('%Y-%m-%d')}"
 
-            if stock_data.empty:
-                self.result_queue.put({
-                    'success': False,
-                    'error': f"未获取到{self.stock_name}({self.stock_code})的数据，可能是非交易日或数据源问题"
-                })
-                return
-
-            # 数据预处理
-            stock_data_processed = stock_data.rename(columns={
-                '时间': 'Date',
-                '开盘': 'Open',
-                '最高': 'High',
-                '最低': 'Low',
-                '收盘': 'Close',
-                '成交量': 'Volume'
-            })
-
-            # 转换时间格式并设置为索引
-            stock_data_processed['Date'] = pd.to_datetime(stock_data_processed['Date'])
-            stock_data_processed.set_index('Date', inplace=True)
-
-            # 确保数据类型正确
-            for col in ['Open', 'High', 'Low', 'Close', 'Volume']:
-                stock_data_processed[col] = pd.to_numeric(stock_data_processed[col], errors='coerce')
-
-            # 计算技术指标
-            stock_data_processed['MA5'] = stock_data_processed['Close'].rolling(window=5).mean()
-            stock_data_processed['MA10'] = stock_data_processed['Close'].rolling(window=10).mean()
-            stock_data_processed['MA20'] = stock_data_processed['Close'].rolling(window=20).mean()
-
-            # 布林带
-            stock_data_processed['BB_middle'] = stock_data_processed['Close'].rolling(window=20).mean()
-            stock_data_processed['BB_std'] = stock_data_processed['Close'].rolling(window=20).std()
-            stock_data_processed['BB_upper'] = stock_data_processed['BB_middle'] + 2 * stock_data_processed['BB_std']
-            stock_data_processed['BB_lower'] = stock_data_processed['BB_middle'] - 2 * stock_data_processed['BB_std']
-
-            # RSI 相对强弱指标
-            def calculate_rsi(data, window=14):
-                delta = data.diff()
-                gain = (delta.where(delta > 0, 0)).rolling(window=window).mean()
-                loss = (-delta.where(delta < 0, 0)).rolling(window=window).mean()
-                rs = gain / loss
-                rsi = 100 - (100 / (1 + rs))
-                return rsi
-
-            stock_data_processed['RSI'] = calculate_rsi(stock_data_processed['Close'])
-
-            # 将处理好的数据放入队列
-            self.result_queue.put({
+            logging.info(f"[{self.window_id}] {self.stock_name}({self.stock_code}) {period}K线数据准备完成")
+            return {
                 'success': True,
                 'data': stock_data_processed,
-                'display_date': target_date.strftime('%Y-%m-%d')
-            })
-
-            logging.info(f"[{self.window_id}] {self.stock_name}({self.stock_code}) 数据获取完成")
+                'view': view,
+                'display_date': display_date
+            }
 
         except Exception as e:
             logging.error(f"[{self.window_id}] 获取K线数据失败: {e}")
-            self.result_queue.put({
+            # 承接状态可能只推进了一半，下次整段重算
+            self.indicator_state = None
+            return {
                 'success': False,
                 'error': f"获取K线数据失败: {str(e)}"
-            })
+            }
+
+    def load_minute_data(self, days):
+        """读取最近days个交易日的1分钟K线，已缓存的部分不再访问网络"""
+        target_date = get_trading_date()
+        logging.info(f"[{self.window_id}] 开始获取 {self.stock_name}({self.stock_code}) 的K线数据，"
+                     f"日期: {target_date.strftime('%Y%m%d')}，共 {days} 个交易日")
+
+        stock_data = self.bar_cache.get_days(self.stock_code, target_date, days, adjust="qfq")
+        self.minute_data = self.prepare_minute_data(stock_data)
+        self.minute_days = days
+
+    def top_up_session(self):
+        """补拉当前交易日的1分钟K线，替换已有数据中当天的部分"""
+        target_date = get_trading_date()
+        session = self.prepare_minute_data(self.bar_cache.get_day(self.stock_code, target_date, adjust="qfq"))
+        if session is None:
+            return
+        earlier = self.minute_data[self.minute_data.index.normalize() < pd.Timestamp(target_date.date())]
+        data = pd.concat([earlier, session])
+        # 加载时当天还没有数据的话，补上当天后去掉最早的一天，保持days个交易日
+        dates = data.index.normalize().unique()
+        self.minute_data = data[data.index.normalize() >= dates[-self.minute_days:][0]]
+
+    @staticmethod
+    def prepare_minute_data(stock_data):
+        """把缓存中的1分钟K线转成以时间为索引、英文列名的数值表，没有数据时返回None"""
+        if stock_data.empty:
+            return None
+
+        # 数据预处理
+        stock_data_processed = stock_data.rename(columns={
+            '时间': 'Date',
+            '开盘': 'Open',
+            '最高': 'High',
+            '最低': 'Low',
+            '收盘': 'Close',
+            '成交量': 'Volume'
+        })
+
+        # 转换时间格式并设置为索引
+        stock_data_processed['Date'] = pd.to_datetime(stock_data_processed['Date'])
+        stock_data_processed.set_index('Date', inplace=True)
+
+        # 确保数据类型正确
+        for col in ['Open', 'High', 'Low', 'Close', 'Volume']:
+            stock_data_processed[col] = pd.to_numeric(stock_data_processed[col], errors='coerce')
+        return stock_data_processed
+
+    def apply_indicators(self, data, view):
+        """给data加上指标列：与已显示的数据同一周期、同一段时只对最后一根及新增K线增量推进，否则整段计算"""
+        previous = self.data if view == self.chart_view else None
+        start = len(previous) - 1 if previous is not None else -1
+        if (self.indicator_state is None or start < 0 or len(data) <= start
+                or not data.index[:start + 1].equals(previous.index)):
+            indicators, self.indicator_state = self.indicator_engine.compute(
+                data['High'].to_numpy(), data['Low'].to_numpy(), data['Close'].to_numpy()
+            )
+            for name, values in indicators.items():
+                data[name] = values
+            return
 
-    def check_result(self):
-        """检查数据获取结果"""
+        # 最后一根K线盘中可能还在变化，替换它后再推进新增的K线
+        highs, lows, closes = (data[column].to_numpy(dtype=float) for column in ('High', 'Low', 'Close'))
+        columns = {name: previous[name].to_numpy(dtype=float)[:start].tolist() for name in self.indicator_engine.names}
+        for t in range(start, len(data)):
+            latest = self.indicator_engine.update(self.indicator_state, highs[t], lows[t], closes[t], replace_last=(t == start))
+            for name in self.indicator_engine.names:
+                columns[name].append(float(latest[name][0]))
+        for name, values in columns.items():
+            data[name] = values
+
+    def on_fetch_done(self, future):
+        """数据获取完成后在界面线程回调"""
+        if self.closed:
+            return
+        self.fetching = False
+        result = future.result()
+        if result['success']:
+            self.display_chart(result['data'], result['display_date'], result['view'])
+        elif self.chart_view is None:
+            self.show_error(result['error'])
+        else:
+            # 实时更新失败时保留已有图表，下一轮再试
+            logging.warning(f"[{self.window_id}] 实时更新失败: {result['error']}")
+        if self.view_changed:
+            self.view_changed = False
+            self.start_fetch(reload=False)
+
+    def display_chart(self, stock_data_processed, display_date, view):
+        """显示K线图：首次显示或切换周期、范围时创建图表，之后原地更新图元"""
         try:
-            result = self.result_queue.get_nowait()
-            if result['success']:
-                self.display_chart(result['data'], result['display_date'])
+            self.data = stock_data_processed
+            if view != self.chart_view:
+                period, date_range = view
+                self.chart_view = view
+                self.chart_title = f'{self.stock_name}({self.stock_code}) - {display_date} {period}K线图'
+                self.session_bars = KLINE_RANGES[date_range] * SESSION_MINUTES // KLINE_PERIODS[period]
+                if self.render_pool is not None:
+                    self.create_image_view()
+                else:
+                    self.create_chart(self.chart_title, self.session_bars)
+            if self.render_pool is not None:
+                self.render_image()
             else:
-                self.show_error(result['error'])
-        except queue.Empty:
-            # 如果窗口还存在，继续检查
-            if self.window and self.window.winfo_exists():
-                self.window.after(100, self.check_result)
+                limits_changed = self.chart.update(stock_data_processed)
+                self.refresh_chart(limits_changed)
 
-    def display_chart(self, stock_data_processed, display_date):
-        """显示K线图"""
-        try:
-            # 创建自定义颜色样式（中国习惯：红涨绿跌）
-            mc = mpf.make_marketcolors(
-                up='red',
-                down='green',
-                edge='inherit',
-                wick={'up': 'red', 'down': 'green'},
-                volume='in',
-            )
+            # 打印技术指标
+            if not stock_data_processed.empty:
+                latest_data = stock_data_processed.iloc[-1]
+                logging.info(f"[{self.window_id}] {self.stock_name}({self.stock_code}) 最新数据:")
+                logging.info(f"收盘价: {latest_data['Close']:.2f}, MA5: {latest_data['MA5']:.2f}, RSI: {latest_data['RSI']:.2f}, "
+                             f"MACD: {latest_data['MACD']:.3f}, K: {latest_data['K']:.2f}, D: {latest_data['D']:.2f}, J: {latest_data['J']:.2f}")
 
-            # 创建图表样式
-            style = mpf.make_mpf_style(
-                marketcolors=mc,
-                gridstyle='-',
-                gridcolor='lightgray',
-                facecolor='white',
-                figcolor='white',
-                rc={'font.family': 'Microsoft YaHei'}
-            )
+        except Exception as e:
+            logging.error(f"[{self.window_id}] 显示K线图失败: {e}")
+            self.chart = None
+            self.chart_view = None
+            self.show_error(f"显示K线图失败: {str(e)}")
 
-            # 准备附加图表（技术指标）
-            apds = [
-                mpf.make_addplot(stock_data_processed['MA5'], color='blue', width=1.5),
-                mpf.make_addplot(stock_data_processed['MA10'], color='purple', width=1.5),
-                mpf.make_addplot(stock_data_processed['MA20'], color='orange', width=1.5),
-                mpf.make_addplot(stock_data_processed['BB_upper'], color='gray', width=1, alpha=0.7),
-                mpf.make_addplot(stock_data_processed['BB_lower'], color='gray', width=1, alpha=0.7),
-                mpf.make_addplot(stock_data_processed['RSI'], panel=2, color='purple', width=1.5),
-                mpf.make_addplot([70] * len(stock_data_processed), panel=2, color='red', width=0.8, linestyle='--', alpha=0.7),
-                mpf.make_addplot([30] * len(stock_data_processed), panel=2, color='green', width=0.8, linestyle='--', alpha=0.7),
-            ]
+    def create_chart(self, title, session_bars):
+        """创建图表并嵌入窗口，横轴预留session_bars根K线的位置"""
+        # 清空图表容器
+        for widget in self.chart_frame.winfo_children():
+            widget.destroy()
+
+        self.chart = KLineChart(title, session_bars)
+        self.background = None
 
-            # 创建matplotlib图形
-            fig, axes = mpf.plot(
-                stock_data_processed,
-                type='candle',
-                style=style,
-                volume=True,
-                addplot=apds,
-                ylabel='价格 (元)',
-                ylabel_lower='成交量',
-                figsize=(12, 8),
-                panel_ratios=(3, 1, 1),
-                tight_layout=True,
-                show_nontrading=False,
-                returnfig=True
-            )
+        # 在Tkinter中嵌入matplotlib图形，每次整图绘制后缓存背景
+        self.canvas = FigureCanvasTkAgg(self.chart.figure, self.chart_frame)
+        self.canvas.mpl_connect('draw_event', self.on_canvas_draw)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
 
-            # 添加图例
-            main_ax = axes[0]
-            legend_elements = [
-                plt.Line2D([0], [0], color='blue', lw=1.5, label='MA5'),
-                plt.Line2D([0], [0], color='purple', lw=1.5, label='MA10'),
-                plt.Line2D([0], [0], color='orange', lw=1.5, label='MA20'),
-                plt.Line2D([0], [0], color='gray', lw=1, alpha=0.7, label='布林带'),
-            ]
-            main_ax.legend(handles=legend_elements, loc='lower right', frameon=True,
-                           fancybox=True, shadow=True, framealpha=0.9, fontsize=10)
-
-            # 为RSI子图添加图例
-            if len(axes) > 2:
-                rsi_ax = axes[2]
-                rsi_legend_elements = [
-                    plt.Line2D([0], [0], color='purple', lw=1.5, label='RSI'),
-                    plt.Line2D([0], [0], color='red', lw=0.8, linestyle='--', alpha=0.7, label='超买(70)'),
-                    plt.Line2D([0], [0], color='green', lw=0.8, linestyle='--', alpha=0.7, label='超卖(30)'),
-                ]
-                rsi_ax.legend(handles=rsi_legend_elements, loc='lower right', frameon=True,
-                              fancybox=True, shadow=True, framealpha=0.9, fontsize=9)
-
-            # 在图表底部添加标题
-            fig.suptitle(f'{self.stock_name}({self.stock_code}) - {display_date} K线图',
-                         fontsize=14, fontweight='bold', y=0.05)
-
-            # 清空图表容器
-            for widget in self.chart_frame.winfo_children():
-                widget.destroy()
+        # 添加工具栏
+        toolbar = NavigationToolbar2Tk(self.canvas, self.chart_frame)
+        toolbar.update()
 
-            # 在Tkinter中嵌入matplotlib图形
-            self.canvas = FigureCanvasTkAgg(fig, self.chart_frame)
-            self.canvas.draw()
-            self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+    def on_canvas_draw(self, event):
+        """整图绘制（首次显示、缩放、改变窗口大小）后缓存不含数据图元的背景，再画上数据图元"""
+        self.background = self.canvas.copy_from_bbox(self.chart.figure.bbox)
+        self.chart.draw_animated()
 
-            # 添加工具栏
-            toolbar = NavigationToolbar2Tk(self.canvas, self.chart_frame)
-            toolbar.update()
+    def refresh_chart(self, limits_changed):
+        """坐标范围变化时整图重绘，否则在缓存背景上只重绘数据图元"""
+        if limits_changed or self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.chart.draw_animated()
+        self.canvas.blit(self.chart.figure.bbox)
 
-            # 打印技术指标
-            if not stock_data_processed.empty:
-                latest_data = stock_data_processed.iloc[-1]
-                logging.info(f"[{self.window_id}] {self.stock_name}({self.stock_code}) 最新数据:")
-                logging.info(f"收盘价: {latest_data['Close']:.2f}, MA5: {latest_data['MA5']:.2f}, RSI: {latest_data['RSI']:.2f}")
+    def create_image_view(self):
+        """离屏模式：图表容器里只放一个显示位图的标签"""
+        for widget in self.chart_frame.winfo_children():
+            widget.destroy()
+        self.image_label = ttk.Label(self.chart_frame, anchor=tk.CENTER)
+        self.image_label.pack(fill=tk.BOTH, expand=True)
+        self.image_label.bind("<Configure>", self.on_image_resize)
+        self.rendered_size = None
+
+    def render_image(self):
+        """按图表容器当前大小提交离屏绘制；同一时间只有一个绘制任务，期间到来的新数据在完成后再绘制"""
+        if self.rendering:
+            self.render_pending = True
+            return
+        size = (max(self.chart_frame.winfo_width(), 400), max(self.chart_frame.winfo_height(), 300))
+        self.rendering = True
+        self.rendered_size = size
+        future = self.render_pool.submit(render_kline_image, self.data, self.chart_title, self.session_bars, *size)
+        self.manager.deliver(future, self.show_image)
+
+    def show_image(self, future):
+        """界面线程只把绘制好的像素贴到标签上"""
+        if self.closed:
+            return
+        self.rendering = False
+        try:
+            from PIL import Image, ImageTk
 
+            width, height, pixels = future.result()
+            self.photo = ImageTk.PhotoImage(Image.frombuffer('RGBA', (width, height), pixels, 'raw', 'RGBA', 0, 1))
+            self.image_label.configure(image=self.photo)
         except Exception as e:
-            logging.error(f"[{self.window_id}] 显示K线图失败: {e}")
-            self.show_error(f"显示K线图失败: {str(e)}")
+            logging.error(f"[{self.window_id}] 离屏绘制K线图失败: {e}")
+        if self.render_pending:
+            self.render_pending = False
+            self.render_image()
+
+    def on_image_resize(self, event):
+        """窗口大小变化停止后按新大小重新绘制"""
+        if self.resize_job:
+            self.window.after_cancel(self.resize_job)
+        self.resize_job = self.window.after(200, self.on_image_resized)
+
+    def on_image_resized(self):
+        self.resize_job = None
+        size = (max(self.chart_frame.winfo_width(), 400), max(self.chart_frame.winfo_height(), 300))
+        if self.data is not None and self.image_label is not None and size != self.rendered_size:
+            self.render_image()
 
     def show_error(self, error_message):
         """显示错误信息"""
@@ -427,14 +2740,213 @@ class KLineWindow:
         """重试获取数据"""
         for widget in self.chart_frame.winfo_children():
             widget.destroy()
-        threading.Thread(target=self.fetch_data_async, daemon=True).start()
-        self.check_result()
+        self.start_fetch()
 
     def on_window_close(self):
-        """窗口关闭处理"""
+        """窗口关闭处理：停止定时任务，释放图形和数据，之后到达的回调直接忽略"""
         logging.info(f"[{self.window_id}] 关闭K线图窗口: {self.stock_name}({self.stock_code})")
+        self.closed = True
+        for job in (self.poll_job, self.resize_job):
+            if job:
+                self.window.after_cancel(job)
+        if self.canvas:
+            self.canvas.get_tk_widget().destroy()
+        if self.chart is not None:
+            self.chart.figure.clear()
+        self.canvas = self.chart = self.background = None
+        self.photo = self.image_label = None
+        self.data = self.minute_data = self.indicator_state = None
+        self.window.destroy()
+        self.manager.forget(self)
+
+
+class KLineWindowManager:
+    """K线图窗口管理：数据获取共用线程池，结果经ProgressBus回到界面线程回调，不再逐窗口轮询；
+    同时打开的窗口数有上限，超出时关闭最久未使用的窗口"""
+
+    def __init__(self, parent, bar_cache, bus, executor, render_pool=None, max_windows=6):
+        self.parent = parent
+        self.bar_cache = bar_cache
+        self.bus = bus
+        self.executor = executor
+        self.render_pool = render_pool
+        self.max_windows = max(1, max_windows)
+        # 按股票代码索引，最近使用的在末尾
+        self.windows = OrderedDict()
+
+    def open(self, stock_code, stock_name):
+        """打开某只股票的K线图，已打开时提到最前"""
+        window = self.windows.get(stock_code)
+        if window is not None:
+            self.touch(window)
+            window.window.lift()
+            window.window.focus()
+            return window
+        while len(self.windows) >= self.max_windows:
+            oldest = next(iter(self.windows.values()))
+            logging.info(f"K线图窗口数达到上限 {self.max_windows}，关闭最久未使用的 {oldest.stock_name}({oldest.stock_code})")
+            oldest.on_window_close()
+        window = KLineWindow(self.parent, stock_code, stock_name, self)
+        self.windows[stock_code] = window
+        logging.info(f"创建K线图窗口: {stock_name}({stock_code}), 当前活跃窗口数: {len(self.windows)}")
+        return window
+
+    def touch(self, window):
+        if self.windows.get(window.stock_code) is window:
+            self.windows.move_to_end(window.stock_code)
+
+    def forget(self, window):
+        if self.windows.get(window.stock_code) is window:
+            del self.windows[window.stock_code]
+
+    def submit(self, callback, func, *args):
+        """在共用线程池执行func，完成后在界面线程调用callback(future)"""
+        future = self.executor.submit(func, *args)
+        self.deliver(future, callback)
+        return future
+
+    def deliver(self, future, callback):
+        """future完成后经ProgressBus在界面线程调用callback(future)"""
+        future.add_done_callback(lambda done: self.bus.call_soon(callback, done))
+
+    def close_all(self):
+        for window in list(self.windows.values()):
+            window.on_window_close()
+
+
+class SparklineGrid:
+    """分时小图网格：每只股票一格，分时走势加成交量条，全部格子画在同一个图表里一次绘制
+
+    1分钟K线经MinuteBarCache批量获取（并发有上限，已缓存的不访问网络）；点击格子打开该股票的K线图。
+    """
+
+    def __init__(self, parent, stocks, bar_cache, manager, max_workers=8):
+        self.parent = parent
+        # [(代码, 名称)]，按显示顺序
+        self.stocks = stocks
+        self.bar_cache = bar_cache
+        self.manager = manager
+        self.max_workers = max_workers
+        count = len(stocks)
+        self.columns = 5 if count <= 20 else 8 if count <= 64 else 10
+        self.rows = -(-count // self.columns)
+        self.figure = None
+        self.canvas = None
+        self.closed = False
+
+        self.window = tk.Toplevel(parent)
+        self.window.title(f"分时网格 - {count}只股票")
+        self.window.geometry("1400x850")
+        self.window.protocol("WM_DELETE_WINDOW", self.on_window_close)
+        self.status_label = ttk.Label(self.window, text=f"正在获取 {count} 只股票的分时数据...")
+        self.status_label.pack(fill=tk.X, padx=10, pady=5)
+        self.chart_frame = ttk.Frame(self.window)
+        self.chart_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+
+        self.manager.submit(self.on_bars_loaded, self.load_bars)
+
+    def load_bars(self):
+        """在共用线程池中批量获取1分钟K线，整理成(股票数, 240)的矩阵"""
+        start_time = time.monotonic()
+        trading_date = get_trading_date()
+        frames = self.bar_cache.get_many([code for code, _ in self.stocks], trading_date, max_workers=self.max_workers)
+        count = len(self.stocks)
+        closes = np.full((count, SESSION_MINUTES), np.nan)
+        volumes = np.zeros((count, SESSION_MINUTES))
+        opens = np.full(count, np.nan)
+        for row, (code, _) in enumerate(self.stocks):
+            frame = frames.get(code)
+            if frame is None or frame.empty:
+                continue
+            slots = session_minutes(pd.DatetimeIndex(pd.to_datetime(frame['时间']))) - 1
+            closes[row, slots] = pd.to_numeric(frame['收盘'], errors='coerce').to_numpy()
+            np.add.at(volumes[row], slots, pd.to_numeric(frame['成交量'], errors='coerce').fillna(0).to_numpy())
+            opens[row] = pd.to_numeric(frame['开盘'], errors='coerce').iloc[0]
+
+        # 停牌等缺失的分钟沿用前值，最后一根之后（盘中尚未到来的时间）留空
+        valid = ~np.isnan(closes)
+        positions = np.arange(SESSION_MINUTES)
+        last_valid = np.maximum.accumulate(np.where(valid, positions, 0), axis=1)
+        closes = closes[np.arange(count)[:, None], last_valid]
+        last_slot = np.where(valid.any(axis=1), SESSION_MINUTES - 1 - np.argmax(valid[:, ::-1], axis=1), -1)
+        closes[positions[None, :] > last_slot[:, None]] = np.nan
+        logging.info(f"分时网格数据准备完成: {count} 只股票，耗时 {time.monotonic() - start_time:.2f}s")
+        return trading_date, closes, volumes, opens, last_slot
+
+    def on_bars_loaded(self, future):
+        if self.closed:
+            return
+        try:
+            trading_date, closes, volumes, opens, last_slot = future.result()
+            start_time = time.monotonic()
+            self.draw(closes, volumes, opens, last_slot)
+            self.status_label.config(text=f"{trading_date.strftime('%Y-%m-%d')} 共 {len(self.stocks)} 只股票，点击格子查看K线图"
+                                          f"（绘制耗时 {time.monotonic() - start_time:.2f}s）")
+        except Exception as e:
+            logging.error(f"绘制分时网格失败: {e}")
+            self.status_label.config(text=f"绘制分时网格失败: {e}")
+
+    def draw(self, closes, volumes, opens, last_slot):
+        """所有格子的走势线合成一个LineCollection、成交量条合成一个PolyCollection，整图只绘制一次"""
+        from matplotlib.collections import LineCollection, PolyCollection
+        from matplotlib.figure import Figure
+
+        count = len(self.stocks)
+        cell_x = np.arange(count) % self.columns
+        cell_y = self.rows - 1 - np.arange(count) // self.columns
+        x = cell_x[:, None] + np.linspace(0.04, 0.96, SESSION_MINUTES)[None, :]
+
+        # 每格按自己的最高最低价缩放，走势占格子上部，成交量条占下部
+        low = np.fmin.reduce(closes, axis=1)
+        high = np.fmax.reduce(closes, axis=1)
+        span = np.where(high > low, high - low, 1)
+        y = cell_y[:, None] + 0.32 + 0.5 * (closes - low[:, None]) / span[:, None]
+        last_close = closes[np.arange(count), np.maximum(last_slot, 0)]
+        change = (last_close / opens - 1) * 100
+        colors = np.where(np.isnan(change), 'gray', np.where(change >= 0, 'red', 'green'))
+
+        peak = volumes.max(axis=1)
+        heights = 0.2 * volumes / np.where(peak > 0, peak, 1)[:, None]
+        bottoms = np.repeat(cell_y[:, None] + 0.06, SESSION_MINUTES, axis=1)
+        traded = volumes.ravel() > 0
+        bars = KLineChart._bars(x.ravel()[traded], bottoms.ravel()[traded], (bottoms + heights).ravel()[traded],
+                                half_width=0.92 / SESSION_MINUTES / 2)
+
+        self.figure = Figure(figsize=(14, 8), facecolor='white')
+        ax = self.figure.add_axes((0, 0, 1, 1))
+        ax.set_xlim(0, self.columns)
+        ax.set_ylim(0, self.rows)
+        ax.axis('off')
+        ax.add_collection(LineCollection(np.stack([x, y], axis=-1), colors=colors.tolist(), linewidths=1))
+        ax.add_collection(PolyCollection(bars, facecolors=np.repeat(colors, SESSION_MINUTES)[traded].tolist(),
+                                         linewidths=0, alpha=0.5))
+        ax.hlines(np.arange(self.rows + 1), 0, self.columns, colors='lightgray', linewidths=0.5)
+        ax.vlines(np.arange(self.columns + 1), 0, self.rows, colors='lightgray', linewidths=0.5)
+        for (code, name), left, bottom, value, color in zip(self.stocks, cell_x, cell_y, change, colors):
+            ax.text(left + 0.04, bottom + 0.95, f"{name} {code}", va='top', fontsize=8)
+            if not np.isnan(value):
+                ax.text(left + 0.96, bottom + 0.95, f"{value:+.2f}%", va='top', ha='right', fontsize=8, color=color)
+
+        self.canvas = FigureCanvasTkAgg(self.figure, self.chart_frame)
+        self.canvas.mpl_connect('button_press_event', self.on_click)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        self.canvas.draw()
+
+    def on_click(self, event):
+        """点击格子打开对应股票的K线图"""
+        if event.xdata is None or event.ydata is None:
+            return
+        index = (self.rows - 1 - int(event.ydata)) * self.columns + int(event.xdata)
+        if 0 <= int(event.xdata) < self.columns and 0 <= index < len(self.stocks):
+            self.manager.open(*self.stocks[index])
+
+    def on_window_close(self):
+        self.closed = True
         if self.canvas:
             self.canvas.get_tk_widget().destroy()
+        if self.figure is not None:
+            self.figure.clear()
+        self.canvas = self.figure = None
         self.window.destroy()
 
 
@@ -478,10 +2990,6 @@ class StockVisualizationApp:
             # 更新状态
             self.startup_label.config(text="正在加载配置...")
             self.master.update()
-            # 添加进度跟踪变量
-            self.processed_count = 0
-            self.failed_count = 0
-            self.progress_lock = threading.Lock()
             # 初始化配置
             ensure_config_file()
             self.announcements = self.load_announcements()
@@ -492,12 +3000,47 @@ class StockVisualizationApp:
             self.normal_font = Font(weight="normal")
             self.announcement_font = Font(family="Microsoft YaHei", size=10, weight="bold")
 
-            # K线图窗口管理
-            self.kline_windows = {}
+            # 抓取调度器在多次刷新间共享，自适应并发的状态得以延续
+            self.fetch_scheduler = FetchScheduler(**load_settings().get("fetch_scheduler", {}))
+
+            # 股票基础资料缓存，启动后在后台刷新过期记录
+            # 数据库写入统一走写线程，界面查询使用只读连接池，刷新数据时不阻塞查询
+            self.database = StockDatabase()
+            self.stock_reference = StockReferenceCache(self.database, scheduler=self.fetch_scheduler)
+            threading.Thread(target=self.stock_reference.warm_up, daemon=True).start()
+            self.ingest_pipeline = IngestPipeline(self.fetch_scheduler, self.stock_reference, self.database)
+            self.minute_bars = MinuteBarCache(self.database, scheduler=self.fetch_scheduler)
+            self.progress_bus = ProgressBus()
+            self.exporter = DataExporter(self.progress_bus)
+
+            # K线图窗口管理：数据获取共用线程池，结果经进度事件通道回调
             self.kline_executor = ThreadPoolExecutor(max_workers=5, thread_name_prefix="KLine")
+            # offscreen模式下K线图在渲染进程池中绘制，进程在第一次绘制时才启动
+            self.render_pool = None
+            settings = load_settings()
+            if settings.get("kline_render_mode") == "offscreen":
+                self.render_pool = ProcessPoolExecutor(max_workers=settings.get("render_processes", 2),
+                                                       initializer=init_render_process)
+            self.kline_manager = KLineWindowManager(self.master, self.minute_bars, self.progress_bus, self.kline_executor,
+                                                    self.render_pool, settings.get("max_kline_windows", 6))
+            # 个股资金流缓存，每次刷新后为排在前面的股票在后台预取
+            self.fund_flows = FundFlowCache(self.database, scheduler=self.fetch_scheduler,
+                                            ttl=settings.get("fund_flow_ttl_seconds", 120))
+            self.fund_flow_ranks = FundFlowRankSource(self.progress_bus, scheduler=self.fetch_scheduler,
+                                                      ttl=settings.get("fund_flow_rank_ttl_seconds", 30))
+            # 大笔买入明细窗口从入库时建好的按股票分组的索引读取
+            self.big_buy_index = BigBuyIndex(self.database)
 
             self.selected_stock = {"code": "", "name": ""}
 
+            # 主界面数据在内存中筛选排序，只有数据刷新后才重新查询数据库
+            self.dataset = None
+            self.dataset_version = 0
+            self.rendered_key = None
+            self.filter_job = None
+            self.view_df = None
+            self.fetch_thread = None
+
             # 更新状态
             self.startup_label.config(text="正在构建界面...")
             self.master.update()
@@ -520,6 +3063,8 @@ class StockVisualizationApp:
             # 启动后台任务
             self.update_announcement()
             self.update_clock()
+            self.drain_progress_events()
+            self.schedule_auto_refresh()
 
             # 界面加载完成，询问是否立即加载数据
             self.show_data_load_option()
@@ -533,7 +3078,7 @@ class StockVisualizationApp:
         result = messagebox.askyesno("数据加载", "是否立即加载股票数据？\n\n点击'是'立即加载（可能需要几分钟）\n点击'否'稍后手动加载")
         if result:
             # 用户选择立即加载
-            threading.Thread(target=self.fetch_data, daemon=True).start()
+            self.start_fetch()
         else:
             self.status_label.config(text="程序已就绪，点击'刷新数据'按钮开始获取股票信息")
 
@@ -720,8 +3265,15 @@ class StockVisualizationApp:
             messagebox.showerror("错误", "公告内容不能为空！")
             return
         try:
+            # 保留配置文件中的其他配置项（api_key、settings等）
+            try:
+                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+            except Exception:
+                config = {}
+            config["announcements"] = announcements
             with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                json.dump({"announcements": announcements}, f, ensure_ascii=False, indent=4)
+                json.dump(config, f, ensure_ascii=False, indent=4)
             self.announcements = announcements
             self.current_announcement_idx = 0
             self.update_announcement()
@@ -735,212 +3287,93 @@ class StockVisualizationApp:
         self.announcement_text.delete(1.0, tk.END)
         self.announcement_text.insert(tk.END, "\n".join(DEFAULT_ANNOUNCEMENTS))
 
+    def start_fetch(self):
+        """在后台线程启动一次刷新，上一次刷新还在进行时忽略"""
+        if self.fetch_thread is not None and self.fetch_thread.is_alive():
+            self.status_label.config(text="上一次刷新尚未完成，请稍候")
+            return
+        self.fetch_thread = threading.Thread(target=self.fetch_data, daemon=True)
+        self.fetch_thread.start()
+
+    def schedule_auto_refresh(self):
+        """按设置的间隔安排下一次自动刷新"""
+        interval = load_settings().get("auto_refresh_seconds", 30)
+        if interval > 0:
+            self.master.after(int(interval * 1000), self.auto_refresh)
+
+    def auto_refresh(self):
+        """交易时段内自动刷新，表格按代码增量更新，开销只与变化的部分有关"""
+        if is_trading_time() and (self.fetch_thread is None or not self.fetch_thread.is_alive()):
+            self.start_fetch()
+        self.schedule_auto_refresh()
+
     def fetch_data(self):
+        """在后台线程运行采集，界面更新全部通过进度事件通道交给主线程"""
+        bus = self.progress_bus
         try:
             if ak is None:
-                self.status_label.config(text="正在初始化数据模块...")
-                self.master.update()
+                bus.status("正在初始化数据模块...")
                 lazy_import_heavy_modules()
 
-            self.status_label.config(text="正在获取大笔买入数据...")
-            self.master.update()
-
-            stock_changes_em_df = ak.stock_changes_em(symbol="大笔买入")
-            split_info = stock_changes_em_df['相关信息'].str.split(',', expand=True)
-            split_info.columns = ['成交量', '成交价', '占成交量比', '成交金额']
-            split_info['成交量'] = pd.to_numeric(split_info['成交量'], errors='coerce')
-            split_info['成交价'] = pd.to_numeric(split_info['成交价'], errors='coerce')
-            split_info['占成交量比'] = pd.to_numeric(split_info['占成交量比'], errors='coerce')
-            split_info['成交金额'] = pd.to_numeric(split_info['成交金额'], errors='coerce')
-            stock_changes_em_df = pd.concat([stock_changes_em_df.drop(columns=['相关信息']), split_info], axis=1)
-            current_date = datetime.now().strftime('%Y%m%d')
-            current_date_obj = datetime.now().date()
-            stock_changes_em_df['时间'] = pd.to_datetime(
-                current_date_obj.strftime('%Y-%m-%d') + ' ' + stock_changes_em_df['时间'].apply(lambda x: x.strftime('%H:%M:%S')),
-                format='%Y-%m-%d %H:%M:%S'
-            )
-
-            self.status_label.config(text="正在保存大笔买入数据到数据库...")
-            self.master.update()
-
-            conn = sqlite3.connect('stock_data.db')
-            table_name = f'stock_changes_{current_date}'
-            try:
-                conn.execute(f"DELETE FROM {table_name}")
-            except sqlite3.OperationalError as e:
-                if "no such table" in str(e):
-                    pass
-                else:
-                    raise
-            except Exception as e:
-                pass
-            stock_changes_em_df.to_sql(table_name, conn, if_exists='append', index=False)
-            logging.info(f"数据已成功存入 SQLite 数据库表 {table_name}！")
-
-            # 准备处理股票实时数据
-            real_data_list = []
-            stock_info = stock_changes_em_df[['代码', '名称']].drop_duplicates(subset=['代码'])
-
-            def not_bj_kcb(row):
-                exchange, market = get_stock_info(row['代码'])
-                return not (exchange == 'bj' or market == '科创板' or market == '创业板')
-
-            filtered_stock_info = stock_info[stock_info.apply(not_bj_kcb, axis=1)]
-
-            # 显示总股票数量
-            total_stocks = len(filtered_stock_info)
-            self.status_label.config(text=f"开始获取 {total_stocks} 只股票的实时数据...")
-            self.master.update()
-
-            # 用于跟踪进度的变量
-            self.processed_count = 0
-            self.failed_count = 0
-            self.progress_lock = threading.Lock()
-
-            def update_progress_status():
-                """更新进度显示"""
-                with self.progress_lock:
-                    progress_percentage = (self.processed_count / total_stocks) * 100
-                    self.status_label.config(
-                        text=f"正在获取股票数据... {self.processed_count}/{total_stocks} "
-                             f"({progress_percentage:.1f}%) - 成功:{self.processed_count - self.failed_count} 失败:{self.failed_count}"
-                    )
-                    self.master.update()
-
-            def process_stock_with_progress(stock_code, stock_name):
-                """带进度更新的process_stock包装函数"""
-                try:
-                    result = self.process_stock(stock_code, stock_name)
-
-                    # 更新进度
-                    with self.progress_lock:
-                        self.processed_count += 1
-                        if result is None:
-                            self.failed_count += 1
-
-                    # 每处理10个股票或者处理完成时更新一次状态显示（避免过于频繁更新）
-                    if self.processed_count % 10 == 0 or self.processed_count == total_stocks:
-                        # 使用after方法在主线程中更新UI
-                        self.master.after(0, update_progress_status)
-
-                    return result
-                except Exception as e:
-                    logging.error(f"处理股票 {stock_code}({stock_name}) 时出错: {e}")
-
-                    # 更新进度
-                    with self.progress_lock:
-                        self.processed_count += 1
-                        self.failed_count += 1
-
-                    # 更新状态显示
-                    if self.processed_count % 10 == 0 or self.processed_count == total_stocks:
-                        self.master.after(0, update_progress_status)
-
-                    return None
-
-            max_workers = min(10, total_stocks)
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                # 创建future到股票代码的映射
-                future_to_stock = {
-                    executor.submit(process_stock_with_progress, row['代码'], row['名称']): (row['代码'], row['名称'])
-                    for _, row in filtered_stock_info.iterrows()
-                }
-
-                # 处理完成的任务
-                for future in as_completed(future_to_stock):
-                    stock_code, stock_name = future_to_stock[future]
-                    try:
-                        result = future.result()
-                        if result:
-                            real_data_list.append(result)
-                    except Exception as e:
-                        logging.error(f"获取股票 {stock_code}({stock_name}) 结果时出错: {e}")
-
-            # 最终状态更新
-            successful_count = len(real_data_list)
-            self.status_label.config(text=f"股票数据获取完成！成功: {successful_count}/{total_stocks} 只股票")
-            self.master.update()
-
-            if not real_data_list:
-                self.status_label.config(text="未获取到任何股票数据")
+            if not load_settings().get("ingest_in_gui", True):
+                # 采集由ingest守护进程负责，界面只读取数据库
+                bus.publish('reload', text="数据已从数据库重新加载")
                 return
 
-            self.status_label.config(text="正在保存股票实时数据到数据库...")
-            self.master.update()
+            result = self.ingest_pipeline.run_cycle(bus)
 
-            stock_real_data_df = pd.DataFrame(real_data_list)
-            real_table_name = f'stock_real_data_{current_date}'
-            try:
-                conn.execute(f"DELETE FROM {real_table_name}")
-            except sqlite3.OperationalError as e:
-                if "no such table" in str(e):
-                    pass
-                else:
-                    raise
-            except Exception as e:
-                pass
-            stock_real_data_df.to_sql(real_table_name, conn, if_exists='replace', index=False)
-            logging.info(f"实时数据已成功存入 SQLite 数据库表 {real_table_name}！")
-            conn.close()
+            if result['total_stocks'] == 0:
+                bus.publish('reload', text="数据刷新完成！没有新的大笔买入事件")
+                return
 
-            self.status_label.config(text=f"数据获取完成！共处理 {successful_count} 只股票，正在加载到表格...")
-            self.master.update()
+            successful_count = result['successful']
+            if successful_count == 0:
+                bus.status("未获取到任何股票数据")
+                return
 
-            # 加载数据到界面
-            self.load_data()
+            bus.status(f"数据获取完成！共处理 {successful_count} 只股票，正在加载到表格...")
 
-            # 最终完成状态
+            # 最终完成状态，由主线程加载数据到界面后显示
             final_message = f"数据刷新完成！成功获取 {successful_count} 只股票数据"
-            if self.failed_count > 0:
-                final_message += f"（失败 {self.failed_count} 只）"
-            self.status_label.config(text=final_message)
+            if result['failed'] > 0:
+                final_message += f"（失败 {result['failed']} 只）"
+            final_message += f"，耗时 {result['timings']['总计']:.1f} 秒"
+            bus.publish('reload', text=final_message)
 
         except Exception as e:
             logging.error(f"数据获取失败: {e}")
-            self.status_label.config(text=f"数据获取失败: {str(e)}")
-
-    def process_stock(self, stock_code, stock_name):
-        try:
-            stock_info_df = ak.stock_individual_info_em(symbol=stock_code)
-            industry = stock_info_df[stock_info_df['item'] == '行业']['value'].iloc[0] if '行业' in stock_info_df['item'].values else '未知'
-            market_cap = stock_info_df[stock_info_df['item'] == '总市值']['value'].iloc[0] if '总市值' in stock_info_df['item'].values else '未知'
-            stock_bid_ask_df = ak.stock_bid_ask_em(symbol=stock_code)
-            latest_price = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '最新']['value'].iloc[0]) if '最新' in stock_bid_ask_df['item'].values else None
-            price_change_percent = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '涨幅']['value'].iloc[0]) if '涨幅' in stock_bid_ask_df[
-                'item'].values else None
-            opening_price = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '今开']['value'].iloc[0]) if '今开' in stock_bid_ask_df['item'].values else None
-
-            turnover_rate = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '换手']['value'].iloc[0]) if '换手' in stock_bid_ask_df['item'].values else None
-            volume_ratio = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '量比']['value'].iloc[0]) if '量比' in stock_bid_ask_df['item'].values else None
+            bus.status(f"数据获取失败: {str(e)}")
+
+    def drain_progress_events(self):
+        """按固定节拍取出进度事件，一批事件只刷新一次状态栏"""
+        status_text = None
+        reload_text = None
+        for event in self.progress_bus.drain():
+            if event['kind'] == 'status':
+                status_text = event['text']
+            elif event['kind'] == 'progress':
+                progress_percentage = (event['processed'] / event['total']) * 100
+                status_text = (f"正在获取股票数据... {event['processed']}/{event['total']} "
+                               f"({progress_percentage:.1f}%) - 成功:{event['processed'] - event['failed']} 失败:{event['failed']}")
+            elif event['kind'] == 'reload':
+                reload_text = event['text']
+            elif event['kind'] == 'callback':
+                try:
+                    event['callback'](*event['args'])
+                except Exception as e:
+                    logging.error(f"界面回调执行失败: {e}")
 
-            max_price = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '最高']['value'].iloc[0]) if '最高' in stock_bid_ask_df['item'].values else None
-            min_price = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '最低']['value'].iloc[0]) if '最低' in stock_bid_ask_df['item'].values else None
-            zhang_ting = float(stock_bid_ask_df[stock_bid_ask_df['item'] == '涨停']['value'].iloc[0]) if '涨停' in stock_bid_ask_df['item'].values else None
-            exchange, market = get_stock_info(stock_code)
-            return {
-                '代码': stock_code,
-                '名称': stock_name,
-                '交易所': exchange,
-                '市场板块': market,
-                '行业': industry,
-                '总市值': int(market_cap / 100000000),
-                '最新': latest_price,
-                '涨幅': price_change_percent,
-                '最高': max_price,
-                '最低': min_price,
-                '涨停': zhang_ting,
-                '换手': turnover_rate,
-                '量比': volume_ratio,
-                '今开': opening_price
-            }
-        except Exception as e:
-            logging.error(f"处理股票代码 {stock_code} ({stock_name}) 时出错: {e}")
-            return None
+        if reload_text is not None:
+            self.load_data()
+            status_text = reload_text
+        if status_text is not None:
+            self.status_label.config(text=status_text)
+        self.master.after(PROGRESS_TICK_MS, self.drain_progress_events)
 
     def create_control_panel(self):
         control_frame = ttk.LabelFrame(self.main_frame, text="控制面板", padding=10)
         control_frame.pack(fill=tk.X, padx=5, pady=5)
-        ttk.Button(control_frame, text="刷新数据", command=lambda: threading.Thread(target=self.fetch_data, daemon=True).start()).pack(side=tk.LEFT, padx=5)
+        ttk.Button(control_frame, text="刷新数据", command=self.start_fetch).pack(side=tk.LEFT, padx=5)
 
         amount_frame = ttk.Frame(control_frame)
         amount_frame.pack(side=tk.LEFT, padx=5)
@@ -966,28 +3399,61 @@ class StockVisualizationApp:
         sort_options = ["总成交金额", "涨幅", "总成笔数", "换手", "量比"]
         sort_combo = ttk.Combobox(control_frame, textvariable=self.sort_var, values=sort_options, width=10, state="readonly")
         sort_combo.pack(side=tk.LEFT, padx=5)
-        sort_combo.bind("<<ComboboxSelected>>", lambda e: self.load_data())
+        self.sort_descending = True
+        sort_combo.bind("<<ComboboxSelected>>", lambda e: self.sort_by_column(self.sort_var.get(), descending=True))
         ttk.Button(control_frame, text="选择显示字段", command=self.select_columns).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(control_frame, text="导出数据", command=self.export_view).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(control_frame, text="分时网格", command=self.show_sparkline_grid).pack(side=tk.RIGHT, padx=5)
 
     def adjust_amount(self, delta):
         try:
             current = int(self.amount_var.get())
             new_value = max(0, current + delta)
             self.amount_var.set(str(new_value))
-            self.load_data()
         except ValueError:
             self.amount_var.set("2000")
-            self.load_data()
+        self.schedule_filter()
 
     def adjust_market_cap(self, delta):
         try:
             current = int(self.market_cap_var.get())
             new_value = max(0, current + delta)
             self.market_cap_var.set(str(new_value))
-            self.load_data()
         except ValueError:
             self.market_cap_var.set("100")
-            self.load_data()
+        self.schedule_filter()
+
+    def export_view(self):
+        """把当前筛选结果导出到选择的文件（xlsx/csv/parquet），写文件在后台进行"""
+        if self.view_df is None or self.view_df.empty:
+            self.status_label.config(text="没有可导出的数据")
+            return
+        filename = filedialog.asksaveasfilename(
+            parent=self.master, title="导出数据", initialfile="stock_data.xlsx", defaultextension=".xlsx",
+            filetypes=[("Excel 文件", "*.xlsx"), ("CSV 文件", "*.csv"), ("Parquet 文件", "*.parquet")]
+        )
+        if not filename:
+            return
+        self.status_label.config(text=f"正在导出数据到 {filename}...")
+        self.exporter.submit(self.view_df, filename)
+
+    def show_sparkline_grid(self):
+        """当前筛选结果（按当前排序取前SPARKLINE_MAX_STOCKS只）的分时小图网格"""
+        if self.view_df is None or self.view_df.empty:
+            self.status_label.config(text="没有可显示的股票")
+            return
+
+        if ak is None:
+            try:
+                lazy_import_heavy_modules()
+            except Exception as e:
+                messagebox.showerror("错误", f"加载图表模块失败: {str(e)}")
+                return
+
+        rows = self.view_df.head(SPARKLINE_MAX_STOCKS)
+        stocks = list(zip(rows["代码"].astype(str), rows["名称"].astype(str)))
+        SparklineGrid(self.master, stocks, self.minute_bars, self.kline_manager)
+        self.status_label.config(text=f"正在打开 {len(stocks)} 只股票的分时网格...")
 
     def select_columns(self):
         select_window = tk.Toplevel(self.master)
@@ -996,7 +3462,7 @@ class StockVisualizationApp:
         all_columns = [
             "代码", "名称", "行业", "交易所", "市场板块", "总市值",
             "今开", "涨幅", "最新", "最低", "最高", "涨停",
-            "换手", "量比", "总成笔数", "总成交金额", "时间金额明细"
+            "换手", "量比", "总成笔数", "总成交金额", "时间金额明细", *FUND_FLOW_RANK_COLUMNS
         ]
         self.column_vars = {}
         for col in all_columns:
@@ -1009,7 +3475,12 @@ class StockVisualizationApp:
     def apply_column_selection(self, window):
         self.display_columns = [col for col, var in self.column_vars.items() if var.get()]
         window.destroy()
-        self.load_data()
+        if self.dataset is not None and any(
+                col in FUND_FLOW_RANK_COLUMNS and col not in self.dataset.columns for col in self.display_columns):
+            # 新选中的资金流排名列需要重新合并数据
+            self.load_data()
+        else:
+            self.apply_filters()
 
     def create_data_table(self):
         self.table_frame = ttk.Frame(self.main_frame)
@@ -1018,33 +3489,20 @@ class StockVisualizationApp:
         self.tree_container = ttk.Frame(self.table_frame)
         self.tree_container.pack(fill=tk.BOTH, expand=True)
 
-        # 创建loading覆盖层
-        self.loading_frame = tk.Frame(self.tree_container, bg='white', bd=2, relief='solid')
-
-        loading_content = tk.Frame(self.loading_frame, bg='white')
-        loading_content.pack(expand=True)
-
-        self.loading_icon = tk.Label(loading_content, text="⟳", font=('Arial', 24), bg='white', fg='#2E86AB')
-        self.loading_icon.pack(pady=5)
-
-        self.loading_text = tk.Label(loading_content, text="正在加载数据...", font=('Microsoft YaHei', 12), bg='white', fg='#333333')
-        self.loading_text.pack(pady=5)
-
         # 配置Treeview样式
         style = ttk.Style()
         # 设置字体大小
         style.configure("Custom.Treeview", font=('Microsoft YaHei', 8))  # 10是字体大小，可以调整
         # 设置行高
-        style.configure("Custom.Treeview", rowheight=30)  # 30是行高，可以调整
+        style.configure("Custom.Treeview", rowheight=TABLE_ROW_HEIGHT)
         # 设置表头字体
         style.configure("Custom.Treeview.Heading", font=('Microsoft YaHei', 11, 'bold'))
 
         # 创建Treeview时使用自定义样式
         self.tree = ttk.Treeview(self.tree_container, show="headings", style="Custom.Treeview")
 
-        # self.tree = ttk.Treeview(self.tree_container, show="headings")
-        self.vsb = ttk.Scrollbar(self.tree_container, orient="vertical", command=self.tree.yview)
-        self.tree.configure(yscrollcommand=self.vsb.set)
+        # 虚拟滚动：Treeview只保留可见范围的行，纵向滚动由滚动条、滚轮和上下键改变数据窗口的起点
+        self.vsb = ttk.Scrollbar(self.tree_container, orient="vertical", command=self.on_table_scroll)
         self.hsb = ttk.Scrollbar(self.tree_container, orient="horizontal", command=self.tree.xview)
         self.tree.configure(xscrollcommand=self.hsb.set)
         self.tree.grid(row=0, column=0, sticky="nsew")
@@ -1054,6 +3512,29 @@ class StockVisualizationApp:
         self.tree_container.grid_columnconfigure(0, weight=1)
         self.tree.bind("<Double-1>", self.show_detail)
         self.tree.bind("<Button-3>", self.on_right_click)
+        self.tree.bind("<Configure>", self.on_table_resize)
+        self.tree.bind("<MouseWheel>", self.on_table_wheel)
+        self.tree.bind("<Button-4>", lambda e: self.scroll_table(-3))
+        self.tree.bind("<Button-5>", lambda e: self.scroll_table(3))
+        self.tree.bind("<Up>", lambda e: self.move_selection(-1))
+        self.tree.bind("<Down>", lambda e: self.move_selection(1))
+        self.tree.bind("<Prior>", lambda e: self.scroll_table(-self.visible_rows))
+        self.tree.bind("<Next>", lambda e: self.scroll_table(self.visible_rows))
+        self.tree.bind("<<TreeviewSelect>>", self.on_table_select)
+        self.tree.tag_configure("up", foreground='red', font=self.bold_font)
+        self.tree.tag_configure("down", foreground='green', font=self.bold_font)
+        self.tree.tag_configure("zero", foreground='gray', font=self.normal_font)
+        # 表格行以代码为iid，rendered_rows记录每行已写入的(显示值, 样式)，刷新时只改写变化的单元格
+        self.table_columns = []
+        self.table_values = []
+        self.table_codes = []
+        self.code_positions = {}
+        self.table_tags = None
+        self.rendered_rows = {}
+        self.view_top = 0
+        self.visible_rows = 20
+        self.table_heading_height = TABLE_ROW_HEIGHT
+        self.selected_code = None
         self.context_menu = tk.Menu(self.master, tearoff=0)
         self.context_menu.add_command(label="大笔买入", command=self.show_big_buy_orders)
         self.context_menu.add_command(label="基本面分析", command=self.show_fundamental)
@@ -1064,38 +3545,6 @@ class StockVisualizationApp:
         self.context_menu.add_command(label="复制股票代码", command=self.copy_stock_code)
         self.context_menu.add_command(label="复制股票名称", command=self.copy_stock_name)
 
-        self.animation_angle = 0
-        self.loading_animation_id = None
-
-    def show_loading(self):
-        """显示加载动画"""
-        self.loading_frame.place(x=0, y=0, relwidth=1, relheight=1)
-        self.loading_frame.lift()
-        self.start_loading_animation()
-
-    def hide_loading(self):
-        """隐藏加载动画"""
-        self.loading_frame.place_forget()
-        self.stop_loading_animation()
-
-    def start_loading_animation(self):
-        """开始loading图标旋转动画"""
-
-        def animate():
-            rotation_chars = ["⟳", "⟲", "◐", "◑", "◒", "◓"]
-            char_index = (self.animation_angle // 60) % len(rotation_chars)
-            self.loading_icon.config(text=rotation_chars[char_index])
-            self.animation_angle = (self.animation_angle + 30) % 360
-            self.loading_animation_id = self.master.after(100, animate)
-
-        animate()
-
-    def stop_loading_animation(self):
-        """停止loading动画"""
-        if self.loading_animation_id:
-            self.master.after_cancel(self.loading_animation_id)
-            self.loading_animation_id = None
-
     def on_right_click(self, event):
         item = self.tree.identify_row(event.y)
         if item:
@@ -1118,6 +3567,13 @@ class StockVisualizationApp:
             messagebox.showwarning("提示", "请先选择一只股票")
             return
 
+        if ak is None:
+            try:
+                lazy_import_heavy_modules()
+            except Exception as e:
+                messagebox.showerror("错误", f"加载数据模块失败: {str(e)}")
+                return
+
         stock_code = self.selected_stock["code"]
         stock_name = self.selected_stock["name"]
         current_date = datetime.now().strftime('%Y%m%d')
@@ -1125,7 +3581,7 @@ class StockVisualizationApp:
         # 创建新窗口
         detail_window = tk.Toplevel(self.master)
         detail_window.title(f"大笔买入明细 - {stock_name}({stock_code})")
-        self.center_window(detail_window, 900, 600)
+        self.center_window(detail_window, 900, 750)
         detail_window.resizable(True, True)
 
         # 创建主框架
@@ -1174,6 +3630,10 @@ class StockVisualizationApp:
         table_frame.grid_rowconfigure(0, weight=1)
         table_frame.grid_columnconfigure(0, weight=1)
 
+        # 每分钟大笔买入金额分布
+        chart_frame = ttk.Frame(main_frame, height=180)
+        chart_frame.pack(fill=tk.X, pady=(10, 0))
+
         # 状态标签
         status_frame = ttk.Frame(main_frame)
         status_frame.pack(fill=tk.X, pady=(10, 0))
@@ -1185,96 +3645,77 @@ class StockVisualizationApp:
         stats_label = ttk.Label(status_frame, text="", font=('Microsoft YaHei', 9))
         stats_label.pack(side=tk.RIGHT)
 
-        # 异步加载数据
-        def load_big_buy_data():
-            try:
-                conn = sqlite3.connect('stock_data.db')
-
-                # 查询大笔买入数据
-                query = f"""
-                SELECT 时间,
-                       代码,
-                       名称,
-                       板块,
-                       成交量,
-                       成交价,
-                       占成交量比,
-                       成交金额
-                FROM stock_changes_{current_date}
-                WHERE 代码 = ?
-                ORDER BY 时间 ASC
-                """
-
-                cursor = conn.execute(query, (stock_code,))
-                rows = cursor.fetchall()
-                conn.close()
+        def draw_histogram(histogram):
+            """按交易分钟画大笔买入金额柱状图，横轴午休不留空"""
+            from matplotlib.figure import Figure
+            from matplotlib.ticker import FuncFormatter
+
+            def slot_label(slot, _pos=None):
+                minutes = int(slot) + 1
+                clock = 9 * 60 + 30 + minutes if minutes <= 120 else 13 * 60 + minutes - 120
+                return f"{clock // 60:02d}:{clock % 60:02d}"
+
+            figure = Figure(figsize=(8.8, 1.8), facecolor='white')
+            ax = figure.add_subplot(111)
+            ax.bar(np.arange(SESSION_MINUTES), histogram / 10000, width=0.8, color='red')
+            ax.set_xlim(-1, SESSION_MINUTES)
+            ax.set_xticks([0, 29, 59, 89, 119, 149, 179, 209, 239])
+            ax.xaxis.set_major_formatter(FuncFormatter(slot_label))
+            ax.set_ylabel('万元', fontsize=8)
+            ax.tick_params(labelsize=8)
+            ax.grid(True, axis='y', alpha=0.3)
+            figure.tight_layout()
+
+            canvas = FigureCanvasTkAgg(figure, chart_frame)
+            canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+            canvas.draw()
+
+        # 在界面线程中显示数据
+        def update_ui(entry):
+            if not detail_window.winfo_exists():
+                return
+            if not entry:
+                status_label.config(text="未找到该股票的大笔买入数据")
+                return
 
-                # 在主线程中更新UI
-                def update_ui():
-                    if not rows:
-                        status_label.config(text="未找到该股票的大笔买入数据")
-                        return
-
-                    # 插入数据到表格
-                    total_amount = 0
-                    total_volume = 0
-
-                    for row in rows:
-                        # 格式化数据
-                        formatted_row = list(row)
-                        # 格式化时间
-                        if formatted_row[0]:
-                            try:
-                                time_obj = datetime.strptime(str(formatted_row[0]), '%Y-%m-%d %H:%M:%S')
-                                formatted_row[0] = time_obj.strftime('%H:%M:%S')
-                            except:
-                                pass
-
-                        # 格式化数字
-                        try:
-                            # 成交量
-                            if formatted_row[4]:
-                                volume = float(formatted_row[4])
-                                formatted_row[4] = f"{volume:,.0f}"
-                                total_volume += volume
-
-                            # 成交价
-                            if formatted_row[5]:
-                                price = float(formatted_row[5])
-                                formatted_row[5] = f"{price:.2f}"
-
-                            # 占成交量比
-                            if formatted_row[6]:
-                                ratio = float(formatted_row[6])
-                                formatted_row[6] = f"{ratio:.2f}%"
-
-                            # 成交金额
-                            if formatted_row[7]:
-                                amount = float(formatted_row[7])
-                                formatted_row[7] = f"{amount:,.0f}"
-                                total_amount += amount
-                        except:
-                            pass
-
-                        tree.insert("", "end", values=formatted_row)
-
-                    # 更新状态和统计信息
-                    status_label.config(text=f"共找到 {len(rows)} 条大笔买入记录")
-                    stats_text = f"总成交量: {total_volume:,.0f}手  总成交金额: {total_amount / 10000:.1f}万元"
-                    stats_label.config(text=stats_text)
-
-                    logging.info(f"加载 {stock_name}({stock_code}) 大笔买入数据完成，共{len(rows)}条记录")
-
-                # 在主线程中执行UI更新
-                detail_window.after(0, update_ui)
+            name, board, events = entry
+            seconds = events['秒']
+            count = len(seconds)
+            # 数组已按时间排好序且是数值类型，直接格式化，不再逐行解析时间字符串；缺失值显示为空
+            rows = zip(
+                [f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}" for s in seconds.tolist()],
+                [stock_code] * count, [name] * count, [board] * count,
+                [f"{v:,.0f}" if pd.notna(v) else "" for v in events['成交量'].tolist()],
+                [f"{v:.2f}" if pd.notna(v) else "" for v in events['成交价'].tolist()],
+                [f"{v:.2f}%" if pd.notna(v) else "" for v in events['占成交量比'].tolist()],
+                [f"{v:,.0f}" if pd.notna(v) else "" for v in events['成交金额'].tolist()],
+            )
+            for row in rows:
+                tree.insert("", "end", values=row)
+            draw_histogram(BigBuyIndex.minute_histogram(events))
 
-            except Exception as e:
-                logging.error(f"加载大笔买入数据失败: {e}")
+            # 更新状态和统计信息
+            total_volume = np.nansum(events['成交量'])
+            total_amount = np.nansum(events['成交金额'])
+            status_label.config(text=f"共找到 {count} 条大笔买入记录")
+            stats_text = f"总成交量: {total_volume:,.0f}手  总成交金额: {total_amount / 10000:.1f}万元"
+            stats_label.config(text=stats_text)
+
+            logging.info(f"加载 {stock_name}({stock_code}) 大笔买入数据完成，共{count}条记录")
 
-                def show_error():
-                    status_label.config(text=f"数据加载失败: {str(e)}")
+        def show_error(message):
+            if detail_window.winfo_exists():
+                status_label.config(text=f"数据加载失败: {message}")
 
-                detail_window.after(0, show_error)
+        # 后台线程只从明细索引取数据，结果经进度事件通道交回界面线程
+        def load_big_buy_data():
+            try:
+                entry = self.big_buy_index.get(current_date, stock_code)
+            except Exception as e:
+                logging.error(f"加载大笔买入数据失败: {e}")
+                self.progress_bus.call_soon(show_error, str(e))
+                return
+            self.progress_bus.call_soon(update_ui, entry)
 
         # 在后台线程中加载数据
         threading.Thread(target=load_big_buy_data, daemon=True).start()
@@ -1355,24 +3796,11 @@ class StockVisualizationApp:
         table_frame.grid_rowconfigure(0, weight=1)
         table_frame.grid_columnconfigure(0, weight=1)
 
-        # 异步获取数据
-        def fetch_fund_flow_data():
+        # 在界面线程中显示数据
+        def display_fund_flow_data(fund_flow_df):
+            if not fund_flow_window.winfo_exists():
+                return
             try:
-                # 确定交易所代码
-                exchange, _ = get_stock_info(stock_code)
-                market_mapping = {
-                    'sh': 'sh',
-                    'sz': 'sz',
-                    'bj': 'bj'
-                }
-                market = market_mapping.get(exchange, 'sh')
-
-                status_label.config(text=f"正在获取{stock_name}({stock_code})的资金流数据...")
-                fund_flow_window.update()
-
-                # 调用akshare获取资金流数据
-                fund_flow_df = ak.stock_individual_fund_flow(stock=stock_code, market=market)
-
                 if fund_flow_df.empty:
                     status_label.config(text="未获取到资金流数据")
                     return
@@ -1491,12 +3919,27 @@ class StockVisualizationApp:
 
                 logging.info(f"成功获取{stock_name}({stock_code})的资金流数据: 最近{len(fund_flow_df)}天的记录")
 
+            except Exception as e:
+                logging.error(f"显示资金流数据失败: {e}")
+                show_error(str(e))
+
+        def show_error(message):
+            if fund_flow_window.winfo_exists():
+                status_label.config(text=f"获取资金流数据失败: {message}")
+                messagebox.showerror("错误", f"获取资金流数据失败: {message}")
+
+        # 后台线程只读缓存或请求网络，结果经进度事件通道交回界面线程显示
+        def fetch_fund_flow_data():
+            try:
+                # 历史资金流来自本地缓存，只有当日数据过期时才请求网络
+                fund_flow_df = self.fund_flows.get(stock_code)
             except Exception as e:
                 logging.error(f"获取资金流数据失败: {e}")
-                status_label.config(text=f"获取资金流数据失败: {str(e)}")
-                messagebox.showerror("错误", f"获取资金流数据失败: {str(e)}")
+                self.progress_bus.call_soon(show_error, str(e))
+                return
+            self.progress_bus.call_soon(display_fund_flow_data, fund_flow_df)
 
-        # 在后台线程中获取数据
+        status_label.config(text=f"正在获取{stock_name}({stock_code})的资金流数据...")
         threading.Thread(target=fetch_fund_flow_data, daemon=True).start()
 
     def show_k_line(self):
@@ -1515,36 +3958,13 @@ class StockVisualizationApp:
         stock_code = self.selected_stock["code"]
         stock_name = self.selected_stock["name"]
 
-        window_key = f"{stock_code}_{stock_name}"
-        if window_key in self.kline_windows:
-            existing_window = self.kline_windows[window_key]
-            if existing_window.window and existing_window.window.winfo_exists():
-                existing_window.window.lift()
-                existing_window.window.focus()
-                return
-            else:
-                del self.kline_windows[window_key]
-
         try:
-            kline_window = KLineWindow(self.master, stock_code, stock_name)
-            self.kline_windows[window_key] = kline_window
-            logging.info(f"创建K线图窗口: {stock_name}({stock_code}), 当前活跃窗口数: {len(self.kline_windows)}")
+            self.kline_manager.open(stock_code, stock_name)
             self.status_label.config(text=f"已打开 {stock_name}({stock_code}) 的K线图")
         except Exception as e:
             logging.error(f"创建K线图窗口失败: {e}")
             messagebox.showerror("错误", f"创建K线图窗口失败: {str(e)}")
 
-    def cleanup_closed_windows(self):
-        """清理已关闭的K线图窗口"""
-        closed_windows = []
-        for key, window in self.kline_windows.items():
-            if not window.window or not window.window.winfo_exists():
-                closed_windows.append(key)
-        for key in closed_windows:
-            del self.kline_windows[key]
-        if closed_windows:
-            logging.info(f"清理了 {len(closed_windows)} 个已关闭的K线图窗口")
-
     def copy_stock_code(self):
         if self.selected_stock["code"]:
             self.master.clipboard_clear()
@@ -1558,136 +3978,243 @@ class StockVisualizationApp:
             self.status_label.config(text=f"已复制股票名称: {self.selected_stock['name']}")
 
     def load_data(self):
-        try:
-            min_amount = int(self.amount_var.get())
-        except ValueError:
-            min_amount = 2000
-            self.amount_var.set("2000")
-        try:
-            min_market_cap = int(self.market_cap_var.get())
-        except ValueError:
-            min_market_cap = 10
-            self.market_cap_var.set("10")
-        sort_by = self.sort_var.get()
+        """数据变化后从数据库读取当日全部汇总数据到内存，再按当前条件筛选显示"""
         current_date = datetime.now().strftime('%Y%m%d')
 
         try:
-            conn = sqlite3.connect('stock_data.db')
-            query = f"""
+            query = """
             SELECT 
                 a.代码, a.名称, b.交易所, b.行业, b.总市值, b.市场板块,
                 b.今开, b.最新, b.涨幅, b.最低, b.最高, b.涨停,
                 b.换手, b.量比,
-                COUNT(1) AS 总成笔数,
-                CAST(SUM(a.成交金额) / 10000 AS INTEGER) AS 总成交金额,
-                GROUP_CONCAT(CAST(a.成交金额 / 10000 AS INTEGER) || '万(' || a.时间 || ')', '|') AS 时间金额明细
+                a.成交笔数 AS 总成笔数,
+                CAST(a.成交金额合计 / 10000 AS INTEGER) AS 总成交金额,
+                a.时间金额明细
             FROM 
-                stock_changes_{current_date} a,
-                stock_real_data_{current_date} b
+                stock_daily_summary a
+                JOIN stock_real_data b ON b.日期 = a.日期 AND b.代码 = a.代码
             WHERE 
-                a.代码 = b.代码 AND b.总市值 >= {min_market_cap}
-            GROUP BY 
-                a.代码, a.名称
-            HAVING 
-                总成交金额 > {min_amount}
+                a.日期 = ?
             ORDER BY 
-                {sort_by} DESC
+                a.代码
             """
 
             if pd is None:
                 lazy_import_heavy_modules()
 
-            full_df = pd.read_sql_query(query, conn)
-            conn.close()
+            # 选中的资金流排名列按代码合并，过期时在后台重新获取，到达后再加载一次
+            frame = self.fund_flow_ranks.join(self.database.query_frame(query, (current_date,)), self.display_columns)
+            self.fund_flow_ranks.refresh(self.display_columns, self.load_data)
+            self.dataset = ScreeningDataset(frame)
+            self.dataset_version += 1
+        except Exception as e:
+            logging.error(f"加载数据失败: {e}")
+            self.status_label.config(text="加载数据失败，请先刷新数据")
+            return
+        self.apply_filters()
+
+        # 为排在前面的股票预热资金流缓存，打开资金流窗口时不用等网络
+        prefetch_count = load_settings().get("fund_flow_prefetch", 30)
+        if prefetch_count and self.view_df is not None:
+            self.fund_flows.prefetch(self.view_df["代码"].astype(str).head(prefetch_count).tolist())
+
+    def sort_by_column(self, column, descending=None):
+        """按列排序：点击当前排序列切换升降序，点击其他列从降序开始；只重排内存数据，不查询数据库"""
+        if descending is None:
+            descending = not self.sort_descending if column == self.sort_var.get() else True
+        self.sort_var.set(column)
+        self.sort_descending = descending
+        self.apply_filters()
+
+    def schedule_filter(self):
+        """筛选条件变化后防抖，连续点击只按最终条件刷新一次"""
+        if self.filter_job is not None:
+            self.master.after_cancel(self.filter_job)
+        self.filter_job = self.master.after(FILTER_DEBOUNCE_MS, self.apply_filters)
+
+    def apply_filters(self):
+        """在内存数据上按当前条件筛选排序并刷新表格，条件和数据都没变时不重绘"""
+        self.filter_job = None
+        try:
+            min_amount = int(self.amount_var.get())
+        except ValueError:
+            min_amount = 2000
+            self.amount_var.set("2000")
+        try:
+            min_market_cap = int(self.market_cap_var.get())
+        except ValueError:
+            min_market_cap = 10
+            self.market_cap_var.set("10")
+        sort_by = self.sort_var.get()
+        if self.dataset is None:
+            return
+
+        render_key = (self.dataset_version, min_amount, min_market_cap, sort_by, self.sort_descending, tuple(self.display_columns))
+        if render_key == self.rendered_key:
+            return
+        # 排序方式变化时回到顶部，其余情况保留滚动位置
+        if self.rendered_key is None or self.rendered_key[3:5] != render_key[3:5]:
+            self.view_top = 0
+        self.rendered_key = render_key
 
+        try:
+            full_df = self.dataset.select(min_amount, min_market_cap, sort_by, self.sort_descending)
+            self.view_df = full_df
             if not full_df.empty:
-                save_to_excel(full_df)
                 available_columns = [col for col in self.display_columns if col in full_df.columns]
                 self.df = full_df[available_columns]
                 self.update_table()
             else:
+                self.clear_table()
                 self.status_label.config(text="没有找到符合条件的数据，请先刷新数据或调整筛选条件")
-
         except Exception as e:
-            logging.error(f"加载数据失败: {e}")
-            self.status_label.config(text="加载数据失败，请先刷新数据")
+            logging.error(f"筛选数据失败: {e}")
+            self.status_label.config(text="筛选数据失败")
+
+    def clear_table(self):
+        """筛选结果为空时清空表格和已渲染行的记录，下次刷新的增量比对从空表开始"""
+        if self.rendered_rows:
+            self.tree.delete(*self.rendered_rows)
+        self.rendered_rows = {}
+        self.table_values = []
+        self.table_codes = []
+        self.code_positions = {}
+        self.table_tags = None
+        self.view_top = 0
+        self.vsb.set(0, 1)
 
     def update_table(self):
-        self.show_loading()
-        self.master.after(10, self._update_table_content)
-
-    def _update_table_content(self):
-        """实际的表格更新内容"""
+        """换上新数据：列不变时保留滚动位置和选中的股票，只同步可见窗口内变化的部分"""
         try:
-            for i in self.tree.get_children():
-                self.tree.delete(i)
-
             columns = list(self.df.columns)
-            self.tree["columns"] = columns
+            if columns != self.table_columns:
+                # 列变化时已有行的值无法对应，清空后重建
+                if self.rendered_rows:
+                    self.tree.delete(*self.rendered_rows)
+                self.rendered_rows = {}
+                self.tree["columns"] = columns
+                self.table_columns = columns
+
+                col_widths = {
+                    "代码": 120, "名称": 120, "交易所": 60, "市场板块": 80, "总市值": 80,
+                    "今开": 70, "涨幅": 70, "最低": 70, "最高": 70, "涨停": 70, "换手": 80, "量比": 80,
+                    "总成笔数": 80, "总成交金额": 100, "时间金额明细": 200,
+                    "今日主力净流入": 110, "近3日主力净流入": 110, "近5日主力净流入": 110
+                }
 
-            col_widths = {
-                "代码": 120, "名称": 120, "交易所": 60, "市场板块": 80, "总市值": 80,
-                "今开": 70, "涨幅": 70, "最低": 70, "最高": 70, "涨停": 70, "换手": 80, "量比": 80,
-                "总成笔数": 80, "总成交金额": 100, "时间金额明细": 200
-            }
+                for col in columns:
+                    self.tree.heading(col, command=lambda c=col: self.sort_by_column(c))
+                    self.tree.column(col, width=col_widths.get(col, 100), anchor="center")
 
+            # 当前排序列的表头显示方向
+            sort_by = self.sort_var.get()
             for col in columns:
-                self.tree.heading(col, text=col)
-                self.tree.column(col, width=col_widths.get(col, 100), anchor="center")
-
-            self._insert_data_batch(0, columns)
-
-        except Exception as e:
-            logging.error(f"更新表格内容失败: {e}")
-            self.hide_loading()
-
-    def _insert_data_batch(self, start_index, columns, batch_size=100):
-        """分批插入数据，每批插入batch_size行"""
-        try:
-            end_index = min(start_index + batch_size, len(self.df))
+                arrow = (" ▼" if self.sort_descending else " ▲") if col == sort_by else ""
+                self.tree.heading(col, text=col + arrow)
 
+            self.table_values = self.df.to_numpy(dtype=object)
+            self.table_codes = self.view_df["代码"].astype(str).tolist()
+            self.code_positions = {code: index for index, code in enumerate(self.table_codes)}
             if "涨幅" in columns:
-                change_idx = columns.index("涨幅")
-                for i in range(start_index, end_index):
-                    row = self.df.iloc[i]
-                    item = self.tree.insert("", "end", values=list(row))
-                    try:
-                        change = float(row["涨幅"])
-                        if change > 0:
-                            self.tree.tag_configure(f"up_{item}", foreground='red', font=self.bold_font)
-                            self.tree.item(item, tags=(f"up_{item}",))
-                        elif change < 0:
-                            self.tree.tag_configure(f"down_{item}", foreground='green', font=self.bold_font)
-                            self.tree.item(item, tags=(f"down_{item}",))
-                        else:
-                            self.tree.tag_configure(f"zero_{item}", foreground='gray', font=self.normal_font)
-                            self.tree.item(item, tags=(f"zero_{item}",))
-                    except ValueError:
-                        pass
+                change = pd.to_numeric(self.df["涨幅"], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+                self.table_tags = np.select([change > 0, change < 0, change == 0], ["up", "down", "zero"], default="").tolist()
             else:
-                for i in range(start_index, end_index):
-                    row = self.df.iloc[i]
-                    self.tree.insert("", "end", values=list(row))
-
-            self.tree.update_idletasks()
-
-            if end_index < len(self.df):
-                self.master.after(20, lambda: self._insert_data_batch(end_index, columns, batch_size))
-            else:
-                self._finish_table_update()
+                self.table_tags = None
+            self.render_visible_rows()
 
         except Exception as e:
-            logging.error(f"批量插入数据失败: {e}")
-            self.hide_loading()
+            logging.error(f"更新表格内容失败: {e}")
 
-    def _finish_table_update(self):
-        """完成表格更新的最后步骤"""
-        try:
-            self.tree.update_idletasks()
-            self.vsb.lift()
-            self.hsb.lift()
-        finally:
-            self.hide_loading()
+    def render_visible_rows(self):
+        """按代码把数据窗口同步到Treeview：进出窗口的行增删，留下的行只改写变化的单元格，行数与数据量无关"""
+        total = len(self.table_values)
+        self.view_top = max(0, min(self.view_top, total - self.visible_rows))
+        window = range(self.view_top, min(total, self.view_top + self.visible_rows + TABLE_OVERSCAN))
+        wanted = {self.table_codes[index] for index in window}
+        stale = [code for code in self.rendered_rows if code not in wanted]
+        if stale:
+            self.tree.delete(*stale)
+            for code in stale:
+                del self.rendered_rows[code]
+
+        for position, index in enumerate(window):
+            code = self.table_codes[index]
+            values = [str(value) for value in self.table_values[index]]
+            tag = self.table_tags[index] if self.table_tags is not None else ""
+            previous = self.rendered_rows.get(code)
+            if previous is None:
+                self.tree.insert("", position, iid=code, values=values, tags=(tag,) if tag else ())
+            else:
+                previous_values, previous_tag = previous
+                for column, old_value, new_value in zip(self.table_columns, previous_values, values):
+                    if old_value != new_value:
+                        self.tree.set(code, column, new_value)
+                if tag != previous_tag:
+                    self.tree.item(code, tags=(tag,) if tag else ())
+                if self.tree.index(code) != position:
+                    self.tree.move(code, "", position)
+            self.rendered_rows[code] = (values, tag)
+
+        # 选中的股票滚回窗口或换了位置后恢复选中
+        if self.selected_code in wanted and self.tree.selection() != (self.selected_code,):
+            self.tree.selection_set(self.selected_code)
+        self.tree.yview_moveto(0)
+
+        if total <= self.visible_rows:
+            self.vsb.set(0, 1)
+        else:
+            self.vsb.set(self.view_top / total, (self.view_top + self.visible_rows) / total)
+
+    def on_table_resize(self, event):
+        """表格高度变化时重新计算可见行数，表头高度取第一行的实际位置"""
+        children = self.tree.get_children()
+        if children:
+            bbox = self.tree.bbox(children[0])
+            if bbox:
+                self.table_heading_height = bbox[1]
+        visible_rows = max(1, (event.height - self.table_heading_height) // TABLE_ROW_HEIGHT)
+        if visible_rows != self.visible_rows:
+            self.visible_rows = visible_rows
+            self.render_visible_rows()
+
+    def on_table_scroll(self, *args):
+        """滚动条回调：moveto按比例定位，scroll按行或按页滚动"""
+        if args[0] == "moveto":
+            self.view_top = int(float(args[1]) * len(self.table_values))
+        elif args[0] == "scroll":
+            self.view_top += int(args[1]) * (self.visible_rows if args[2] == "pages" else 1)
+        self.render_visible_rows()
+
+    def scroll_table(self, rows):
+        self.view_top += rows
+        self.render_visible_rows()
+        return "break"
+
+    def on_table_wheel(self, event):
+        # Windows上delta为120的倍数，macOS上为较小的整数
+        rows = -event.delta // 120 * 3 if abs(event.delta) >= 120 else -event.delta
+        return self.scroll_table(rows)
+
+    def move_selection(self, step):
+        """上下键移动选中行，移出可见范围时滚动表格"""
+        total = len(self.table_values)
+        if total == 0:
+            return "break"
+        current = self.code_positions.get(self.selected_code)
+        index = 0 if current is None else min(max(current + step, 0), total - 1)
+        self.selected_code = self.table_codes[index]
+        if index < self.view_top:
+            self.view_top = index
+        elif index >= self.view_top + self.visible_rows:
+            self.view_top = index - self.visible_rows + 1
+        self.render_visible_rows()
+        return "break"
+
+    def on_table_select(self, event):
+        """记录选中的股票代码，滚动和刷新后据此恢复选中"""
+        selection = self.tree.selection()
+        if selection:
+            self.selected_code = selection[0]
 
     def show_detail(self, event):
         item = self.tree.selection()[0]
@@ -1720,23 +4247,49 @@ class StockVisualizationApp:
         """清理资源"""
         if hasattr(self, 'kline_executor'):
             self.kline_executor.shutdown(wait=False)
+        if hasattr(self, 'exporter'):
+            self.exporter.executor.shutdown(wait=False)
+        if getattr(self, 'render_pool', None):
+            self.render_pool.shutdown(wait=False, cancel_futures=True)
+        if hasattr(self, 'fund_flows'):
+            self.fund_flows.executor.shutdown(wait=False, cancel_futures=True)
+        if hasattr(self, 'fund_flow_ranks'):
+            self.fund_flow_ranks.executor.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == "__main__":
-    root = tk.Tk()
-    try:
-        root.iconbitmap(default="logo.ico")
-    except:
-        pass  # 如果图标文件不存在，忽略错误
-
-    app = StockVisualizationApp(root)
-
-
-    # 定期清理已关闭的K线图窗口
-    def periodic_cleanup():
-        app.cleanup_closed_windows()
-        root.after(30000, periodic_cleanup)  # 每30秒清理一次
-
-
-    root.after(30000, periodic_cleanup)
-    root.mainloop()
+    # 打包成单文件后，渲染进程池的子进程需要由此进入
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="草船借箭")
+    subparsers = parser.add_subparsers(dest="command")
+    ingest_parser = subparsers.add_parser("ingest", help="无界面运行数据采集")
+    ingest_parser.add_argument("--interval", type=int, default=30, help="采集间隔（秒），默认30")
+    ingest_parser.add_argument("--once", action="store_true", help="立即采集一轮后退出，不检查交易时段")
+    migrate_parser = subparsers.add_parser("migrate", help="把旧版按天分表的数据导入统一表")
+    migrate_parser.add_argument("--drop-legacy", action="store_true", help="导入后删除旧表")
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        run_ingest_daemon(args.interval, args.once)
+    elif args.command == "migrate":
+        # 重建大笔买入明细索引要用pandas
+        lazy_import_heavy_modules()
+        conn = open_database()
+        try:
+            count = migrate_legacy_tables(conn, args.drop_legacy)
+            logging.info(f"迁移完成，共导入 {count} 张旧表")
+        finally:
+            conn.close()
+    else:
+        root = tk.Tk()
+        try:
+            root.iconbitmap(default="logo.ico")
+        except:
+            pass  # 如果图标文件不存在，忽略错误
+
+        app = StockVisualizationApp(root)
+        root.mainloop()
+        if getattr(app, 'render_pool', None):
+            app.render_pool.shutdown(wait=False, cancel_futures=True)
+        if hasattr(app, 'database'):
+            app.database.close()
@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def heavy_modules(monkeypatch):
+    """main中的numpy/pandas是延迟导入的，测试直接注入，不需要akshare"""
+    monkeypatch.setattr(main, 'np', np)
+    monkeypatch.setattr(main, 'pd', pd)
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = main.open_database(str(tmp_path / 'stock_data.db'))
+    yield conn
+    conn.close()
+
+
+def big_buy_frame(rows):
+    frame = pd.DataFrame(rows, columns=main.BIG_BUY_COLUMNS)
+    frame['时间'] = pd.to_datetime(frame['时间'])
+    return frame
+
+
+def test_ingest_keeps_backfilled_events_before_high_water_mark(conn):
+    first = big_buy_frame([
+        ['2024-01-02 09:33:00', '600000', '浦发银行', '银行', 1000, 10.0, 1.0, 1000000],
+        ['2024-01-02 09:33:05', '000001', '平安银行', '银行', 2000, 11.0, 2.0, 2200000],
+    ])
+    assert main.ingest_big_buy_events(conn, first, '20240102')[0] == 2
+
+    # 数据源补发了一条时间早于高水位的事件
+    backfilled = pd.concat([first, big_buy_frame([
+        ['2024-01-02 09:31:30', '600000', '浦发银行', '银行', 3000, 10.1, 3.0, 3030000],
+    ])], ignore_index=True)
+    new_count, codes = main.ingest_big_buy_events(conn, backfilled, '20240102')
+    assert (new_count, codes) == (1, {'600000'})
+    assert conn.execute("SELECT COUNT(*) FROM stock_changes").fetchone()[0] == 3
+    assert main.ingest_big_buy_events(conn, backfilled, '20240102')[0] == 0
+
+
+def test_full_ingest_updates_high_water_mark(conn):
+    events = big_buy_frame([['2024-01-02 10:00:00', '600000', '浦发银行', '银行', 1000, 10.0, 1.0, 1000000]])
+    main.ingest_big_buy_events(conn, events, '20240102', mode="full")
+    mark = conn.execute("SELECT high_water_mark FROM ingest_watermark WHERE 日期 = '20240102'").fetchone()[0]
+    assert mark == '2024-01-02 10:00:00'
+
+
+def test_migrate_legacy_big_buy_table(conn):
+    conn.execute("CREATE TABLE stock_changes_20240102 (时间 TEXT, 代码 TEXT, 名称 TEXT, 板块 TEXT, "
+                 "成交量 REAL, 成交价 REAL, 占成交量比 REAL, 成交金额 REAL)")
+    conn.executemany("INSERT INTO stock_changes_20240102 VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [
+        ('2024-01-02 09:31:00', '600000', '浦发银行', '银行', 1000, 10.0, 1.0, 1000000),
+        ('2024-01-02 10:15:30', '600000', '浦发银行', '银行', 2000, 10.2, 2.0, 2040000),
+        ('2024-01-02 13:05:00', '000001', '平安银行', '银行', 3000, 11.0, 3.0, 3300000),
+    ])
+    conn.commit()
+
+    assert main.migrate_legacy_tables(conn) == 1
+    assert conn.execute("SELECT COUNT(*) FROM stock_changes WHERE 日期 = '20240102'").fetchone()[0] == 3
+    summary = dict(conn.execute("SELECT 代码, 成交笔数 FROM stock_daily_summary WHERE 日期 = '20240102'").fetchall())
+    assert summary == {'600000': 2, '000001': 1}
+
+    count, data = conn.execute(
+        "SELECT 笔数, 数据 FROM big_buy_index WHERE 日期 = '20240102' AND 代码 = '600000'").fetchone()
+    events = main.unpack_big_buy_events(data)
+    assert count == 2
+    assert events['秒'].tolist() == [9 * 3600 + 31 * 60, 10 * 3600 + 15 * 60 + 30]
+    np.testing.assert_allclose(events['成交金额'], [1000000, 2040000])
+
+
+def screening_frame(rows):
+    columns = ['代码', '名称', '总市值', '涨幅', '总成笔数', '总成交金额']
+    return pd.DataFrame(rows, columns=columns)
+
+
+def test_screening_select_empty_frame():
+    # 当天还没有入库数据时read_sql_query返回的空表，各列都是object类型
+    dataset = main.ScreeningDataset(screening_frame([]).astype(object))
+    selected = dataset.select(0, 0, '总成交金额')
+    assert selected.empty
+    assert list(selected.columns) == dataset.columns
+
+
+def test_screening_select_all_null_market_cap():
+    frame = screening_frame([
+        ['000001', '平安银行', None, 1.5, 10, 3000],
+        ['000002', '万科A', None, -0.5, 20, 5000],
+    ])
+    assert frame['总市值'].dtype == object
+    dataset = main.ScreeningDataset(frame)
+    assert dataset.select(0, 0, '总成交金额').empty
+    assert dataset.select(0, 0, '总市值').empty
+
+
+def test_screening_select_filters_and_sorts():
+    frame = screening_frame([
+        ['000001', '平安银行', 100.0, 1.5, 10, 3000],
+        ['000002', '万科A', 50.0, -0.5, 20, 5000],
+        ['000004', '国华网安', 10.0, 2.0, 5, 8000],
+    ])
+    selected = main.ScreeningDataset(frame).select(1000, 20, '总成交金额')
+    assert selected['代码'].tolist() == ['000002', '000001']
+
+
+def test_indicator_update_replaces_last_bar_of_one_bar_state():
+    rng = np.random.default_rng(0)
+    close = 10 + rng.standard_normal(30).cumsum() * 0.1
+    high = close + 0.05
+    low = close - 0.05
+    engine = main.IndicatorEngine()
+
+    # 盘中第一根K线还没走完：先按一根计算，再替换它并继续推进
+    _, state = engine.compute(high[:1] - 0.02, low[:1] + 0.02, close[:1] + 0.01)
+    latest = engine.update(state, high[0], low[0], close[0], replace_last=True)
+    assert state.count == 1
+    for t in range(1, len(close)):
+        latest = engine.update(state, high[t], low[t], close[t])
+
+    expected, _ = engine.compute(high, low, close)
+    for name in engine.names:
+        np.testing.assert_allclose(latest[name][0], expected[name][-1], equal_nan=True)